@@ -4,17 +4,35 @@ import asyncio
 import numpy as np
 import time
 from caproto.server import ioc_arg_parser, run, pvproperty, PVGroup
-from caproto import AlarmStatus, AlarmSeverity
+from caproto import AlarmStatus, AlarmSeverity, ChannelType, ChannelDouble
 import simulacrum
 import zmq
 from zmq.asyncio import Context
-from collections import deque
 from functools import partial
 
 #set up python logger
 L = simulacrum.util.SimulacrumLog(os.path.splitext(os.path.basename(__file__))[0], level='INFO')
 
 HIST_BUF_SIZE = 2800
+N_EDEFS = 4
+
+def link_deadband(prop):
+    """
+    Writing a BPM PV's .MDEL sets the service's deadband for it (see BPMService.publish_orbit),
+    rather than caproto's monitor filtering, so changes are only ever filtered once.
+    """
+    @prop.fields.monitor_deadband.getter
+    async def get_deadband(fields, instance):
+        # Read back what was written, not the channel's value_atol.
+        return None
+
+    @prop.fields.monitor_deadband.putter
+    async def put_deadband(fields, instance, value):
+        group = fields.parent.group
+        if group.deadband_callback:
+            group.deadband_callback(fields.parent.pvname, value)
+        return value
+    return prop
 
 class BPMPV(PVGroup):
 
@@ -35,25 +53,135 @@ class BPMPV(PVGroup):
         max_length=HIST_BUF_SIZE
         )
 
-    x       = pvprop_position(name=':X')
+    x       = link_deadband(pvprop_position(name=':X'))
     x_hstbr = pvprop_position_buffer(name=':XHSTBR')
-    x_hst1  = pvprop_position_buffer(name=':XHST1')
-    x_hst2  = pvprop_position_buffer(name=':XHST2')
 
-    y       = pvprop_position(name=':Y')
+    y       = link_deadband(pvprop_position(name=':Y'))
     y_hstbr = pvprop_position_buffer(name=':YHSTBR')
-    y_hst1  = pvprop_position_buffer(name=':YHST1')
-    y_hst2  = pvprop_position_buffer(name=':YHST2')
 
-    tmit       = pvprop_tmit(name=':TMIT')
+    tmit       = link_deadband(pvprop_tmit(name=':TMIT'))
     tmit_hstbr = pvprop_tmit_buffer(name=':TMITHSTBR')
-    tmit_hst1  = pvprop_tmit_buffer(name=':TMITHST1')
-    tmit_hst2  = pvprop_tmit_buffer(name=':TMITHST2')
 
     z = pvproperty(value=0.0, name=':Z', read_only=True, precision=2, units='m')
 
-    
+    def __init__(self, deadband_callback=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.deadband_callback = deadband_callback
+
+
+class BPMOrbitPV(PVGroup):
+    """ Machine-wide orbit waveforms, ordered by z, so that a whole orbit
+    can be read with a single CA get.  All waveforms share one timestamp. """
+    element_names = pvproperty(value=[''], name=':ELEMENT_NAMES', dtype=ChannelType.STRING, read_only=True)
+    device_names = pvproperty(value=[''], name=':NAMES', dtype=ChannelType.STRING, read_only=True)
+    z = pvproperty(value=[0.0], name=':Z', read_only=True, precision=2, units='m')
+    x = pvproperty(value=[0.0], name=':X', read_only=True, precision=4, units='mm')
+    y = pvproperty(value=[0.0], name=':Y', read_only=True, precision=4, units='mm')
+    tmit = pvproperty(value=[0.0], name=':TMIT', read_only=True)
+    alive = pvproperty(value=[0], name=':ALIVE', read_only=True)
+    pulse_id = pvproperty(value=0, name=':PULSEID', read_only=True)
+    suppressed = pvproperty(value=0.0, name=':SUPPRESSED_COUNT', read_only=True, precision=0,
+                            doc="Scalar BPM updates suppressed by monitor deadbands")
+
+    def __init__(self, orbit, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The waveform lengths are only known now, so we fix up caproto's private data.
+        for attr in ('element_names', 'device_names', 'z', 'x', 'y', 'tmit', 'alive'):
+            getattr(self, attr)._max_length = len(orbit)
+        self.element_names._data['value'] = orbit['element_name'].tolist()
+        self.device_names._data['value'] = orbit['device_name'].tolist()
+        self.z._data['value'] = orbit['z'].astype(float)
+        for attr in ('x', 'y', 'tmit'):
+            getattr(self, attr)._data['value'] = orbit[attr].astype(float)
+        self.alive._data['value'] = orbit['alive'].astype(np.int32)
+
+    async def publish_orbit(self, orbit, timestamp):
+        # astype copies, so each published waveform is a snapshot of this orbit.
+        await asyncio.gather(*[getattr(self, attr).write(orbit[attr].astype(float), timestamp=timestamp, verify_value=False)
+                               for attr in ('x', 'y', 'tmit')],
+                             self.alive.write(orbit['alive'].astype(np.int32), timestamp=timestamp, verify_value=False))
+
+class EDEF:
+    """ An event definition: every step-th pulse from start_pulse, averaged in groups
+    of n_average, for n_measurements measurements (0 keeps acquiring forever). """
+    def __init__(self, number, name):
+        self.number = number
+        self.name = name
+        self.n_measurements = 0
+        self.n_average = 1
+        self.step = 1
+        self.start_pulse = None
+        # Data from a finished or stopped acquisition, which the pulse store will soon overwrite.
+        self.frozen = None
+        self.needs_publish = False
+
+    @property
+    def pulses_per_measurement(self):
+        return self.step * self.n_average
+
+    @property
+    def acquiring(self):
+        return self.start_pulse is not None and self.frozen is None
+
+    def completed(self, pulse_id):
+        """ Number of measurements completed as of pulse_id. """
+        if self.start_pulse is None:
+            return 0
+        done = max(0, (pulse_id - self.start_pulse + 1) // self.pulses_per_measurement)
+        return min(done, self.n_measurements) if self.n_measurements else done
+
+class EDEFPV(PVGroup):
+    """ Control PVs for one event definition.  Writing NAME reserves the EDEF,
+    clearing it releases it, and CTRL starts and stops acquisition using the
+    current MEASCNT, AVGCNT and RATE. """
+    edef_name = pvproperty(value='', name=':NAME', dtype=ChannelType.STRING)
+    meascnt = pvproperty(value=100, name=':MEASCNT')
+    avgcnt = pvproperty(value=1, name=':AVGCNT')
+    rate = pvproperty(value=120.0, name=':RATE', units='Hz')
+    ctrl = pvproperty(value="OFF", name=':CTRL', dtype=ChannelType.ENUM, enum_strings=("OFF", "ON"))
+    cnt = pvproperty(value=0, name=':CNT', read_only=True)
+
+    def __init__(self, number, name_callback, ctrl_callback, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.number = number
+        self.name_callback = name_callback
+        self.ctrl_callback = ctrl_callback
+
+    @edef_name.putter
+    async def edef_name(self, instance, value):
+        await self.name_callback(self.number, value)
+        return value
+
+    @ctrl.putter
+    async def ctrl(self, instance, value):
+        if value == "ON":
+            self.ctrl_callback(self.number, True, n_measurements=self.meascnt.value,
+                               n_average=self.avgcnt.value, rate=self.rate.value)
+        else:
+            self.ctrl_callback(self.number, False)
+        return value
+
 class BPMService(simulacrum.Service):
+    # Beam-synchronous acquisition settings.  The rates can be set from the environment, like the model ports.
+    beam_rate = float(os.environ.get('BPM_BEAM_RATE', 120.0))
+    publish_rate = float(os.environ.get('BPM_PUBLISH_RATE', 2.0))
+    position_resolution = 0.005 # mm, uncorrelated from BPM to BPM.
+    position_jitter = 0.02 # mm, shot-to-shot beam motion seen by every BPM.
+    tmit_resolution = 0.005 # Fraction of TMIT, uncorrelated from BPM to BPM.
+    tmit_jitter = 0.01 # Fraction of TMIT, shot-to-shot charge jitter.
+    max_backlog = 0.5 # Seconds of late pulses to catch up on before dropping them.
+    publish_chunk = 64 # Channel writes between yields to the acquisition loop while publishing.
+    # Monitor deadbands, like MDEL: X, Y and TMIT are only published when they move by more
+    # than max(absolute, relative * |last published value|).  Each PV's absolute deadband
+    # can be changed through its .MDEL field, and a negative one publishes every update.
+    # The defaults are a few times the shot-to-shot jitter, so a steady beam isn't republished.
+    position_deadband = 0.05 # mm
+    tmit_deadband = 0.0
+    relative_deadband = 0.03
+    # EDEF buffers are views of the pulse store, so they have to fit well inside it.
+    max_edef_span = HIST_BUF_SIZE // 2
+    report_period = 10.0
+
     def __init__(self):
         super().__init__()
         self.ctx = Context.instance()
@@ -64,17 +192,33 @@ class BPMService(simulacrum.Service):
         device_names = [simulacrum.util.convert_element_to_device(bpm[0]) for bpm in bpms]
         L.debug(device_names)
         device_name_map = zip(bpms, device_names)
-        bpm_pvs = {device_name: BPMPV(prefix=device_name) for device_name in device_names if device_name}
+        bpm_pvs = {device_name: BPMPV(self.on_deadband_change, prefix=device_name) for device_name in device_names if device_name}
         self.add_pvs(bpm_pvs)
-        one_hertz_aliases = {}
-        for pv in self:
+        for pv in list(self):
             if pv.endswith(":X") or pv.endswith(":Y") or pv.endswith(":TMIT"):
-                one_hertz_aliases["{}1H".format(pv)] = self[pv]
-        self.update(one_hertz_aliases)
+                self.add_alias("{}1H".format(pv), pv)
+        self.make_edef_channels(list(bpm_pvs))
+        self.edefs = {number: None for number in range(1, N_EDEFS + 1)}
+        self.edef_pvs = {number: EDEFPV(number, self.on_edef_name, self.on_edef_ctrl, prefix="EDEF:SYS0:{}".format(number))
+                         for number in self.edefs}
+        self.add_pvs(self.edef_pvs)
         self.orbit = self.initialize_orbit(bpms)
+        self.orbit_pvs = BPMOrbitPV(self.orbit, prefix="SIMULACRUM:SYS0:1:BPM")
+        self.add_pvs(self.orbit_pvs)
         self.history = self.initialize_history_buffers(bpms)
+        self.resolve_channels()
+        self.initialize_acquisition()
         L.info("Initialization complete.")
     
+    def make_edef_channels(self, device_names):
+        """ Per-EDEF history buffers, (X|Y|TMIT)HST<n>, which share their BPM's alarm. """
+        for device_name in device_names:
+            alarm = self[device_name+":X"].alarm
+            for number in range(1, N_EDEFS + 1):
+                for attr, units, precision in (("X", 'mm', 4), ("Y", 'mm', 4), ("TMIT", '', 0)):
+                    self["{}:{}HST{}".format(device_name, attr, number)] = ChannelDouble(
+                        value=[np.nan], max_length=HIST_BUF_SIZE, alarm=alarm, units=units, precision=precision)
+
     def initialize_orbit(self, bpms):
         # First, get the list of BPMs and their Z locations from the model service
         # This is maybe brittle because we use Tao's "show" command, then parse
@@ -96,19 +240,227 @@ class BPMService(simulacrum.Service):
 
     def initialize_history_buffers(self, bpms):
         """
-        construct self.history ring buffers for X, Y and TMIT
-        We'll need 3 * N_bpms buffers!
+        construct self.history, one ring buffer for X, Y and TMIT of every BPM,
+        with shape (3, N_bpms, 2 * history_length).  Each sample is stored twice,
+        history_length apart, so the ordered history is always a contiguous slice.
+        The ring is longer than HIST_BUF_SIZE by a publication's worth of pulses,
+        so the views on the history PVs aren't written over before the next one.
         """
         L.info("Initializing history buffers.")
-        x_history, y_history, tmit_history = [], [], []
-        all_nans = np.full((HIST_BUF_SIZE,), np.nan)
-        for i in range(len(bpms)):
-            x_history.append(deque(all_nans, maxlen=HIST_BUF_SIZE))
-            y_history.append(deque(all_nans, maxlen=HIST_BUF_SIZE))
-            tmit_history.append(deque(all_nans, maxlen=HIST_BUF_SIZE))
-
-        return [x_history, y_history, tmit_history]
+        self.history_length = HIST_BUF_SIZE + int(np.ceil(self.beam_rate * (2.0 / self.publish_rate + self.max_backlog)))
+        self.history_index = self.history_length - 1
+        return np.full((3, len(bpms), 2 * self.history_length), np.nan, dtype=np.float32)
+
+    def append_history(self):
+        """ Append the current orbit to every BPM's history with one column assignment. """
+        i = self.history_index = (self.history_index + 1) % self.history_length
+        sample = np.stack((self.orbit['x'], self.orbit['y'], self.orbit['tmit']))
+        self.history[:, :, i] = sample
+        self.history[:, :, i + self.history_length] = sample
+
+    def history_view(self):
+        """ The ordered (3, N_bpms, HIST_BUF_SIZE) history, oldest first, as a view. """
+        stop = self.history_index + self.history_length + 1
+        return self.history[:, :, stop - HIST_BUF_SIZE:stop]
     
+    def resolve_channels(self):
+        """
+        Look up every BPM's channels once, in orbit order, so publishing an orbit
+        doesn't need to build PV names and search the service for each BPM.
+        """
+        self.pv_rows = np.array([i for i, row in enumerate(self.orbit) if row['device_name']+":X" in self], dtype=int)
+        devices = self.orbit['device_name'][self.pv_rows]
+        self.channels = {attr: [self[device+suffix] for device in devices]
+                         for attr, suffix in (('x', ':X'), ('y', ':Y'), ('tmit', ':TMIT'))}
+        self.history_channels = [[self[device+suffix] for device in devices]
+                                 for suffix in (':XHSTBR', ':YHSTBR', ':TMITHSTBR')]
+        self.edef_channels = {number: [[self["{}:{}HST{}".format(device, attr, number)] for device in devices]
+                                       for attr in ("X", "Y", "TMIT")]
+                              for number in range(1, N_EDEFS + 1)}
+        # Absolute deadbands for X, Y and TMIT of every BPM, in the same order as the channels.
+        self.deadband = np.empty((len(self.channels), len(self.pv_rows)))
+        self.deadband_index = {}
+        for a, (channels, deadband) in enumerate(zip(self.channels.values(), (self.position_deadband, self.position_deadband, self.tmit_deadband))):
+            self.deadband[a] = deadband
+            for j, chan in enumerate(channels):
+                chan.field_inst.monitor_deadband._data['value'] = deadband
+                self.deadband_index[chan.pvname] = (a, j)
+        self.last_published = np.full((len(self.channels), len(self.pv_rows)), np.nan, dtype=np.float32)
+        self.suppressed_count = 0
+        # Every PV in a BPMPV shares one alarm, so severity is set once per BPM.
+        self.alarms = [chan.alarm for chan in self.channels['x']]
+        self.severity = np.full(len(self.pv_rows), AlarmSeverity.NO_ALARM)
+        self.publish_time = 0.0
+
+    def on_deadband_change(self, pvname, value):
+        self.deadband[self.deadband_index[pvname]] = value
+
+    def initialize_acquisition(self):
+        self.rng = np.random.default_rng()
+        n = len(self.orbit)
+        # The latest orbit from the model.  self.orbit holds the most recent pulse.
+        self.model_orbit = np.zeros(n, dtype=[('x', 'float32'), ('y', 'float32'), ('tmit', 'float32'), ('alive', 'bool')])
+        # Each BPM sees the shot-to-shot beam motion with its own fixed response, like a betatron phase.
+        self.jitter_response = self.rng.standard_normal((2, n), dtype=np.float32)
+        # Pulse ID of the latest acquired pulse.  It also indexes the pulse store, self.history.
+        self.pulse_id = -1
+        self.missed_deadlines = 0
+        self.dropped_pulses = 0
+
+    def acquire_pulse(self):
+        """
+        Acquire one beam pulse for every BPM at once: the latest model orbit,
+        plus per-BPM resolution noise and shot-to-shot jitter.
+        """
+        noise = self.rng.standard_normal((3, len(self.orbit)), dtype=np.float32)
+        jitter = self.rng.standard_normal(3, dtype=np.float32)
+        self.orbit['x'] = self.model_orbit['x'] + self.position_resolution*noise[0] + self.position_jitter*jitter[0]*self.jitter_response[0]
+        self.orbit['y'] = self.model_orbit['y'] + self.position_resolution*noise[1] + self.position_jitter*jitter[1]*self.jitter_response[1]
+        self.orbit['tmit'] = self.model_orbit['tmit'] * (1.0 + self.tmit_resolution*noise[2] + self.tmit_jitter*jitter[2])
+        self.orbit['alive'] = self.model_orbit['alive']
+        self.append_history()
+        self.pulse_id += 1
+
+    async def acquire(self):
+        """
+        Beam-rate acquisition loop.  Pulses are scheduled against absolute deadlines.
+        If the loop falls behind, the late pulses are acquired in a burst and counted
+        as missed deadlines, and anything more than max_backlog late is dropped.
+        """
+        period = 1.0 / self.beam_rate
+        max_backlog_pulses = max(1, int(self.max_backlog / period))
+        start = time.perf_counter()
+        pulse = 0
+        while True:
+            due = int((time.perf_counter() - start) / period) + 1 - pulse
+            if due > 1:
+                self.missed_deadlines += due - 1
+                if due > max_backlog_pulses:
+                    self.dropped_pulses += due - max_backlog_pulses
+                    pulse += due - max_backlog_pulses
+                    due = max_backlog_pulses
+            for _ in range(max(due, 0)):
+                self.acquire_pulse()
+            pulse += max(due, 0)
+            self.freeze_finished_edefs()
+            await asyncio.sleep(max(0.0, start + pulse*period - time.perf_counter()))
+
+    async def publish_periodically(self):
+        last_report = time.perf_counter()
+        reported = (self.pulse_id, self.missed_deadlines, self.dropped_pulses)
+        while True:
+            await asyncio.sleep(1.0 / self.publish_rate)
+            await self.publish_orbit()
+            now = time.perf_counter()
+            if now - last_report < self.report_period:
+                continue
+            pulses, missed, dropped = (self.pulse_id - reported[0], self.missed_deadlines - reported[1],
+                                       self.dropped_pulses - reported[2])
+            if missed:
+                L.warning("Missed %d pulse deadlines (%d pulses dropped, %d acquired) at %g Hz in the last %.0f seconds. Last publish took %.3f seconds.",
+                          missed, dropped, pulses, self.beam_rate, now - last_report, self.publish_time)
+            last_report = now
+            reported = (self.pulse_id, self.missed_deadlines, self.dropped_pulses)
+
+    def reserve_edef(self, name, number=None):
+        """ Reserve an EDEF, the first free one unless a number is given.  Returns the EDEF number. """
+        if number is None:
+            free = [n for n, edef in self.edefs.items() if edef is None]
+            if not free:
+                raise ValueError("No free EDEFs.")
+            number = free[0]
+        if self.edefs[number] is not None:
+            raise ValueError("EDEF {} is reserved by '{}'.".format(number, self.edefs[number].name))
+        self.edefs[number] = EDEF(number, name)
+        L.info("EDEF %d reserved by '%s'.", number, name)
+        return number
+
+    async def release_edef(self, number):
+        self.edefs[number] = None
+        # verify_value=False posts the change without running the CTRL putter again.
+        await self.edef_pvs[number].ctrl.write("OFF", verify_value=False)
+
+    def start_edef(self, number, n_measurements, n_average=1, rate=None):
+        """
+        Start acquiring n_measurements (0 for forever), each the average of
+        n_average pulses at rate (the beam rate by default), from the next pulse.
+        """
+        edef = self.edefs[number]
+        if edef is None:
+            raise ValueError("EDEF {} is not reserved.".format(number))
+        step = max(1, int(round(self.beam_rate / rate))) if rate else 1
+        if n_measurements < 0 or n_average < 1:
+            raise ValueError("EDEF needs a non-negative measurement count and an average count of at least 1.")
+        span = max(n_measurements, 1) * n_average * step
+        if span > self.max_edef_span:
+            raise ValueError("EDEF {} would need {} pulses of history, but only {} are available.".format(number, span, self.max_edef_span))
+        edef.n_measurements, edef.n_average, edef.step = n_measurements, n_average, step
+        edef.start_pulse = self.pulse_id + 1
+        edef.frozen = None
+        edef.needs_publish = True
+
+    def stop_edef(self, number):
+        edef = self.edefs[number]
+        if edef is not None and edef.acquiring:
+            edef.frozen = np.array(self.edef_data(edef))
+            edef.needs_publish = True
+
+    def freeze_finished_edefs(self):
+        for edef in self.edefs.values():
+            if edef is not None and edef.acquiring and edef.n_measurements and edef.completed(self.pulse_id) >= edef.n_measurements:
+                edef.frozen = np.array(self.edef_data(edef))
+                edef.needs_publish = True
+
+    def edef_data(self, edef):
+        """
+        The (3, N_bpms, n) measurements an EDEF has completed.  While acquiring,
+        without averaging, this is a strided view of the pulse store, so any
+        number of EDEFs share one store and add no per-pulse work.
+        """
+        if edef.frozen is not None:
+            return edef.frozen
+        done = edef.completed(self.pulse_id)
+        n = done if edef.n_measurements else min(done, self.max_edef_span // edef.pulses_per_measurement)
+        span = n * edef.pulses_per_measurement
+        last_pulse = edef.start_pulse + done * edef.pulses_per_measurement - 1
+        # The latest pulse sits at history_index + history_length, see append_history.
+        stop = self.history_index + self.history_length - (self.pulse_id - last_pulse) + 1
+        data = self.history[:, :, stop - span:stop:edef.step]
+        if edef.n_average > 1:
+            data = data.reshape(data.shape[0], data.shape[1], n, edef.n_average).mean(axis=-1)
+        return data
+
+    async def on_edef_name(self, number, name):
+        if not name:
+            await self.release_edef(number)
+        elif self.edefs[number] is None:
+            self.reserve_edef(name, number)
+        else:
+            self.edefs[number].name = name
+
+    def on_edef_ctrl(self, number, on, **settings):
+        if on:
+            self.start_edef(number, **settings)
+        else:
+            self.stop_edef(number)
+
+    def edef_writes(self, timestamp):
+        """ Channel writes for every EDEF that is acquiring or has just finished. """
+        writes = []
+        for number, edef in self.edefs.items():
+            if edef is None or not (edef.acquiring or edef.needs_publish):
+                continue
+            edef.needs_publish = False
+            data = self.edef_data(edef)
+            if data.shape[-1]:
+                for buffers, channels in zip(data, self.edef_channels[number]):
+                    writes.extend(chan.write(buffers[i], timestamp=timestamp, verify_value=False) for i, chan in zip(self.pv_rows, channels))
+            pvs = self.edef_pvs[number]
+            writes.append(pvs.cnt.write(edef.completed(self.pulse_id) if edef.frozen is None else data.shape[-1], timestamp=timestamp))
+            if not edef.acquiring and pvs.ctrl.value == "ON":
+                writes.append(pvs.ctrl.write("OFF", timestamp=timestamp, verify_value=False))
+        return writes
+
     def fetch_bpm_list(self):
         self.cmd_socket.send_pyobj({"cmd": "tao", "val": "show data orbit.x"})
         orbit_bpms = [row.split()[3] for row in self.cmd_socket.recv_pyobj()['result'][3:-2]]
@@ -145,55 +497,74 @@ class BPMService(simulacrum.Service):
                 buf = memoryview(msg)
                 A = np.frombuffer(buf, dtype=md['dtype'])
                 A = A.reshape(md['shape'])
-                self.orbit['x'] = A[0]
-                self.orbit['y'] = A[1]
-                self.orbit['alive'] = A[2] > 0
-                L.debug(self.orbit)
-                await self.publish_orbit()
+                self.model_orbit['x'] = A[0]
+                self.model_orbit['y'] = A[1]
+                self.model_orbit['alive'] = A[2] > 0
+                L.debug(self.model_orbit)
             else: 
                 await model_broadcast_socket.recv(flags=flags, copy=copy, track=track)
 
     async def publish_orbit(self):
+        """
+        Publish the latest pulse in one pass: one timestamp, alarm severities updated
+        only for BPMs whose state changed, and the writes made publish_chunk at a time,
+        yielding to the event loop in between so that acquisition keeps its pulse
+        deadlines while a large orbit is published.
+        """
+        start = time.perf_counter()
         ts = time.time()
-        for i, row in enumerate(self.orbit):
-            if row['device_name']+":X" not in self: continue
-
-            if not row['alive']:
-                severity = AlarmSeverity.INVALID_ALARM
-            else:
-                severity = AlarmSeverity.NO_ALARM
-
-            await self[row['device_name']+":X"].write(row['x'], severity=severity, timestamp=ts)
-            await self[row['device_name']+":Y"].write(row['y'], severity=severity, timestamp=ts)
-            await self[row['device_name']+":TMIT"].write(row['tmit'], timestamp=ts)
-
-            # update history buffers
-            self.history[0][i].append(row['x'])
-            self.history[1][i].append(row['y'])
-            self.history[2][i].append(row['tmit'])
-
-            x_hst = list(self.history[0][i])
-            y_hst = list(self.history[1][i])
-            tmit_hst = list(self.history[2][i])
+        rows = self.pv_rows
+        pulse_id = self.pulse_id
+        snapshot = self.orbit[['x', 'y', 'tmit', 'alive']].copy()
+        orbit = snapshot[rows]
 
-            # 'HST1' and 'HST2' are simple duplicates of the 'HSTBR' buffer to reduce memory cost
-            # no simulated timing anyways, so custom EDEFs aren't meaningful
+        severity = np.where(orbit['alive'], AlarmSeverity.NO_ALARM, AlarmSeverity.INVALID_ALARM)
+        severity_changed = np.flatnonzero(severity != self.severity)
+        self.severity = severity
 
-            await self[row['device_name']+":XHSTBR"].write(x_hst, severity=severity, timestamp=ts)
-            await self[row['device_name']+":XHST1"].write(x_hst, severity=severity, timestamp=ts)
-            await self[row['device_name']+":XHST2"].write(x_hst, severity=severity, timestamp=ts)
+        values = np.stack([orbit[attr] for attr in self.channels])
+        threshold = np.maximum(self.deadband, self.relative_deadband * np.abs(self.last_published))
+        # Comparisons with NaN are False, so anything never published yet goes out.
+        changed = (self.deadband < 0) | ~(np.abs(values - self.last_published) <= threshold)
+        self.last_published[changed] = values[changed]
+        self.suppressed_count += changed.size - np.count_nonzero(changed)
+        history = self.history_view()
+        edef_writes = self.edef_writes(ts)
 
-            await self[row['device_name']+":YHSTBR"].write(y_hst, severity=severity, timestamp=ts)
-            await self[row['device_name']+":YHST1"].write(y_hst, severity=severity, timestamp=ts)
-            await self[row['device_name']+":YHST2"].write(y_hst, severity=severity, timestamp=ts)
+        def writes():
+            # Made one at a time as they're awaited, so building thousands of them doesn't stall the loop either.
+            for channels, vals, mask in zip(self.channels.values(), values, changed):
+                for j in np.flatnonzero(mask):
+                    yield channels[j].write(vals[j], timestamp=ts, verify_value=False)
+            # The history channels are pointed at this pulse's views of the ring, once per publication.
+            for buffers, channels in zip(history, self.history_channels):
+                for i, chan in zip(rows, channels):
+                    yield chan.write(buffers[i], timestamp=ts, verify_value=False)
+            # The orbit waveforms are skipped when no BPM moved past its deadband, but the
+            # pulse ID and suppressed count go out every time.
+            if changed.any():
+                yield self.orbit_pvs.publish_orbit(snapshot, ts)
+            yield self.orbit_pvs.pulse_id.write(pulse_id, timestamp=ts, verify_value=False)
+            yield self.orbit_pvs.suppressed.write(self.suppressed_count, timestamp=ts, verify_value=False)
+            yield from edef_writes
 
-            await self[row['device_name']+":TMITHSTBR"].write(tmit_hst, timestamp=ts)
-            await self[row['device_name']+":TMITHST1"].write(tmit_hst, timestamp=ts)
-            await self[row['device_name']+":TMITHST2"].write(tmit_hst, timestamp=ts)
+        # An alarm write updates every channel of its BPM, about 20 of them, so yield after each one.
+        for j in severity_changed:
+            await self.alarms[j].write(severity=AlarmSeverity(severity[j]))
+            await asyncio.sleep(0)
+        # Awaited one at a time: gathering them costs more than the writes themselves.
+        for i, write in enumerate(writes(), 1):
+            await write
+            if i % self.publish_chunk == 0:
+                await asyncio.sleep(0)
+        self.publish_time = time.perf_counter() - start
+        L.debug("Published orbit for %d BPMs in %.3f seconds, %d scalar updates suppressed so far.",
+                len(rows), self.publish_time, self.suppressed_count)
 
     async def orbit_broadcast(self, async_lib):
         """
-        'startup_hook' coroutine, listens for orbit broadcast from model
+        'startup_hook' coroutine, listens for orbit broadcast from model and starts
+        the beam-rate acquisition and publishing loops
         'async_lib' arg is a requirement of caproto so that 'startup_hook' is library-agnostic
         but this method only works for asyncio
         """
@@ -201,6 +572,8 @@ class BPMService(simulacrum.Service):
         loop = asyncio.get_running_loop()
         loop.call_soon(self.request_orbit)
         loop.create_task(self.recv_orbit_array())
+        loop.create_task(self.acquire())
+        loop.create_task(self.publish_periodically())
 
 def main():
     service = BPMService()
@@ -1,19 +1,130 @@
 import os
 import sys
 import asyncio
+import atexit
+import signal
+import multiprocessing
+import zlib
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from collections import OrderedDict
+from caproto import ChannelDouble, ChannelInteger
 from caproto.server import ioc_arg_parser, run, pvproperty, PVGroup
 import simulacrum
+from simulacrum.route_channel import ByteRoute, DoubleRoute, ShortRoute
 import zmq
 import time
 from zmq.asyncio import Context
-import pickle
-from scipy.stats import gaussian_kde
+import json
+from scipy.fft import rfft2, irfft2, next_fast_len
+from scipy.special import erf
 #set up python logger
 L = simulacrum.util.SimulacrumLog(os.path.splitext(os.path.basename(__file__))[0], level='INFO')
 
+class ProfMonStatsPV(PVGroup):
+    suppressed = pvproperty(value=0.0, name=':SUPPRESSED_COUNT', read_only=True, precision=0,
+                            doc="Screen image updates suppressed by monitor deadbands")
+    cache_hit_ratio = pvproperty(value=0.0, name=':CACHE_HIT_RATIO', read_only=True, precision=3,
+                                 doc="Fraction of screen renders served from the frame cache")
+    cache_bytes = pvproperty(value=0.0, name=':CACHE_BYTES', read_only=True, precision=0, units='B',
+                             doc="Memory used by cached frames")
+    cache_frames = pvproperty(value=0.0, name=':CACHE_FRAMES', read_only=True, precision=0,
+                              doc="Number of cached frames")
+
+class ProfMonPV(PVGroup):
+    """
+    The PVs every simulated screen has.  Image and camera property PVs differ between
+    cameras, so ProfMonService.add_screen makes those as channels of their own.
+    """
+    #non-zero acquires frames continuously.
+    acquire = pvproperty(value=0, name=':Acquisition', read_only=False, mock_record='ai')
+    frame_rate = pvproperty(value=0.0, name=':FRAME_RATE', read_only=False, units='Hz', mock_record='ai')
+    #frame buffer: IMG_BUF_IDX counts frames, writing a frame number to IMG_BUF_SEL puts that frame on IMG_BUF.
+    buf_idx = pvproperty(value=0, name=':IMG_BUF_IDX', read_only=False, mock_record='ai')
+    buf_size = pvproperty(value=0, name=':IMG_BUF_SIZE', read_only=True)
+    buf_sel = pvproperty(value=0, name=':IMG_BUF_SEL', read_only=False)
+    render_time = pvproperty(value=0.0, name=':SIM_RENDER_TIME', read_only=True, units='s', precision=3)
+    img_save = pvproperty(value=0, name=':SAVE_IMG', read_only=False, mock_record='ai')
+
+    def __init__(self, device_name, service, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.device_name = device_name
+        self.service = service
+        self.frame_rate._data['value'] = service.default_frame_rate
+        self.buf_size._data['value'] = service.frame_buffer_length
+
+    @acquire.putter
+    async def acquire(self, instance, value):
+        self.service.frame_requested[self.device_name].set()
+        return value
+
+    @buf_sel.putter
+    async def buf_sel(self, instance, value):
+        return await self.service.select_buffered_frame(self.device_name, value)
+
 class ProfMonService(simulacrum.Service):
+    # Startup budget: under 1 s to import and build the PVs, under 150 MB resident before
+    # the first render.  Screens are defined in screenProps.json, one ProfMonPV group and a
+    # channel per camera property each.  Image PVs, frame buffers and rings all start out as
+    # zeros that are only paged in when written, so image memory (about 3 MB a frame for a
+    # 1392x1040 camera, times frame_buffer_length for its ring) is only spent on screens
+    # that are rendered.
+    screen_dtype = np.dtype([('element_name', 'U60'), ('device_name', 'U60'), ('image_name', 'U60'),
+                             ('props', 'U60', (25,)), ('values', 'f4', (25,))])
     default_image_dim = 1024
+    # Monitor deadbands for the screen images: a screen is only re-rendered and published
+    # when its beam moves by more than position_deadband (mm), or its beta functions or
+    # energy change by more than relative_deadband.  A negative deadband publishes every update.
+    position_deadband = 1e-3
+    relative_deadband = 1e-3
+    # Add shot noise to rendered images, as if they were made from n_part particles.
+    shot_noise = True
+    rng = np.random.default_rng()
+    # Smallest kernel width (pixels) for images made from particle positions.
+    kde_min_bandwidth = 0.5
+    # Screens are only rendered on demand: when their image PV is monitored, was read in the
+    # last recent_read_period seconds, or has :Acquisition enabled.  Other screens keep their
+    # latest beam parameters, and render them when they are next read or monitored.
+    recent_read_period = 10.0
+    demand_check_period = 1.0
+    # Rendered frames are cached by screen and beam parameters, least recently used first out.
+    # Positions (mm) are rounded to cache_position_quantum, betas and energy to a relative
+    # cache_relative_quantum, so beams closer than that share a frame (and its shot noise).
+    frame_cache_size = float(os.environ.get('PROFMON_CACHE_MB', 256))*2**20
+    cache_position_quantum = 1e-4
+    cache_relative_quantum = 1e-5
+    # Everything else a frame depends on: the screen values the render reads (sensor size, bit
+    # depth, calibration, ROI, reticle center and binning) and the noise model settings.
+    cache_camera_props = [0, 1, 2, 3, 4, 5, 6, 7, 10, 11, 18, 19]
+    cache_noise_settings = ('shot_noise', 'detector_noise', 'detector_seed', 'dark_level', 'dark_variation',
+                            'gain_variation', 'dead_pixel_fraction', 'hot_pixel_fraction', 'readout_noise')
+    # Each screen acquires at most :FRAME_RATE frames a second (non-positive means no limit),
+    # and holds off while its image subscribers have more than max_frame_backlog updates queued.
+    default_frame_rate = 10.0
+    max_frame_backlog = 2
+    backlog_poll_period = 0.05
+    # While :Acquisition is on, a screen acquires continuously at its frame rate, and each frame
+    # gets its own shot noise and frame_jitter (mm rms) of beam position jitter.  The last
+    # frame_buffer_length frames are kept in a ring, read back through :IMG_BUF_SEL and :IMG_BUF.
+    frame_jitter = 0.01
+    frame_buffer_length = int(os.environ.get('PROFMON_BUFFER_FRAMES', 10))
+    # Detector model, in fractions of full scale: a dark background with fixed-pattern variation,
+    # per-pixel gain variation, dead and hot pixels, and readout noise drawn from a bank of
+    # noise_bank_size samples that each render worker reuses cyclically.  The static maps are
+    # seeded by detector_seed and screen, so they are the same every time the service starts.
+    detector_noise = True
+    detector_seed = 0
+    dark_level = 5e-3
+    dark_variation = 1e-3
+    gain_variation = 0.02
+    dead_pixel_fraction = 1e-5
+    hot_pixel_fraction = 1e-5
+    readout_noise = 1e-3
+    noise_bank_size = 2**22
+    # Binning and ROI setpoints live at these indices of a screen's values, next to the ROI
+    # readbacks at 4-7.  Cameras without them in screenProps get areaDetector names.
+    geometry_setpoints = {18: 'BinX', 19: 'BinY', 20: 'MinX', 21: 'MinY', 22: 'SizeX', 23: 'SizeY'}
     util_pvs = ['EVR:IN20:PM01:CTRL.DG0E', 'EVR:IN20:PM02:CTRL.DG1E', 'EVR:IN20:PM02:CTRL.DG0E',
                 'EVR:IN20:PM03:CTRL.DG0E', 'EVR:IN20:PM03:CTRL.DG1E', 'EVR:IN20:PM04:CTRL.DG1E',
                 'EVR:IN20:PM04:CTRL.DG0E', 'EVR:IN20:PM05:CTRL.DG1E', 'EVR:IN20:PM05:CTRL.DG0E',
@@ -30,9 +141,10 @@ class ProfMonService(simulacrum.Service):
         super().__init__()
 
         #load Profmon properties from file
-        path_to_screen_props = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'screenProps.dat')
-        with open(path_to_screen_props, 'rb') as file_handle:
-            screens = pickle.load(file_handle)
+        path_to_screen_props = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'screenProps.json')
+        with open(path_to_screen_props) as file_handle:
+            screens = np.array([tuple(screen[field] for field in self.screen_dtype.names) for screen in json.load(file_handle)],
+                               dtype=self.screen_dtype)
 
         #build dicts to translate element name/device name
         self.ele2dev = {}
@@ -43,56 +155,21 @@ class ProfMonService(simulacrum.Service):
                 self.dev2ele[screenProps['device_name']] = screenProps['element_name']
                 self.profiles[screenProps['device_name']] = {'props': screenProps}
 
-        def ProfMonPVClassMaker(screenProps):
-            pvLen = len(screenProps['device_name'])
-            image_name = screenProps['image_name'][pvLen:]
-
-            if not screenProps['values'][6]*screenProps['values'][7]:
-                screenProps['values'][[0, 1, 6, 7]] = self.default_image_dim
-                #screenProps['values'][2] = self.default_image_dim
-                #screenProps['values'][6] = self.default_image_dim
-                #screenProps['values'][7] = self.default_image_dim
-
-            image_size = int(screenProps['values'][6] * screenProps['values'][7])
-            image= pvproperty(value=np.zeros(image_size).tolist(), name = image_name, read_only=True, mock_record='ai')
-            
-            #dummy pv for EVR acquisition 
-            acquire = pvproperty(value = "Acquire", name = ':Acquisition', read_only=False, mock_record='ai');
-            frame_rate = pvproperty(value = 0, name = ':FRAME_RATE', read_only=True, mock_record='ai');
-            buf_idx =  pvproperty(value = 0, name = ':IMG_BUF_IDX', read_only=False, mock_record='ai');
-            img_save = pvproperty(value = 0, name = ':SAVE_IMG', read_only=False, mock_record='ai');
-            try:
-                pvProps = { screenProps['props'][i].split(':')[3]: pvproperty(value = float(screenProps['values'][i]), name = ':' + screenProps['props'][i].split(':')[3], read_only=False, mock_record='ai') 
-                            for i in range(0, len(screenProps['props'])) if screenProps['props'][i]
-                        }
-            except IndexError:
-                msg = '{} has an invalid device name'.format(screen)
-                L.info(msg)
-                return None
-            pvProps.update({'acquire': acquire, 'frame_rate': frame_rate, 'buf_idx': buf_idx, 'img_save': img_save, 'image': image})
-            return type(screenProps['device_name'], (PVGroup,), pvProps)
-
-        def UtilPVClassMaker(PVName):
-            pv = pvproperty(value = 0, name = PVName, read_only=False, mock_record='ai');
-            return type(PVName, (PVGroup,), {'pv': pv})
-
-        screen_pvs = {}         
-        util_pvs = {} 
-
+        self.image2dev = {}
         for screen in self.profiles:
-            msg='PV: {} {}'.format(screen, self.dev2ele[screen])
-            ProfClass = ProfMonPVClassMaker(self.profiles[screen]['props'])
-            if(ProfClass):
-                screen_pvs[screen] = ProfClass(prefix = screen)
+            self.add_screen(self.profiles[screen]['props'])
 
         for pv in self.util_pvs:
             prefix = ':'.join(pv.split(':')[0:3])
-            suffix = pv.split(':')[3]
-            UtilPVClass = UtilPVClassMaker(':' + suffix)
-            screen_pvs[pv] = UtilPVClass(prefix = prefix)
+            if prefix in self.image2dev.values():
+                #simulated screens have their own
+                continue
+            self[pv] = ChannelInteger(value=0)
 
-        self.add_pvs(screen_pvs)
-        self.add_pvs(util_pvs)
+        self.stats_pvs = ProfMonStatsPV(prefix='SIMULACRUM:SYS0:1:PROF')
+        self.add_pvs(self.stats_pvs)
+        self.initialize_deadbands()
+        self.initialize_render_pool()
         self.ctx = Context.instance()
         #cmd socket is a synchronous socket, we don't want the asyncio context.
         self.cmd_socket = zmq.Context().socket(zmq.REQ)
@@ -100,6 +177,374 @@ class ProfMonService(simulacrum.Service):
         
         L.info("Initialization complete.")
 
+    def add_screen(self, screenProps):
+        """
+        Add a screen's PVs: a ProfMonPV group, a channel per camera property, and its image
+        and :IMG_BUF waveforms.  The waveforms hold no image memory until they are written.
+        """
+        devName = screenProps['device_name']
+        values = screenProps['values']
+        if not values[6]*values[7]:
+            values[[0, 1, 6, 7]] = self.default_image_dim
+            # The ROI setpoints start out describing the same ROI, the whole default sensor.
+            values[[20, 21, 22, 23]] = values[[4, 5, 6, 7]]
+        for index, suffix in self.geometry_setpoints.items():
+            if not screenProps['props'][index]:
+                screenProps['props'][index] = devName + ':' + suffix
+                values[index] = 1 if index < 20 else values[index - 16]
+        if any(len(name.split(':')) < 4 for name in screenProps['props'] if name):
+            L.info('{} has an invalid device name'.format(devName))
+            return
+
+        for i, name in enumerate(screenProps['props']):
+            if not name:
+                continue
+            pvName = devName + ':' + name.split(':')[3]
+            if i in self.geometry_setpoints:
+                self[pvName] = DoubleRoute(pvName, None, self.geometry_putter(devName, i), value=float(values[i]))
+            else:
+                self[pvName] = ChannelDouble(value=float(values[i]))
+
+        # The image can be as big as the sensor, but starts out the size of the binned ROI.
+        # Images stay numpy arrays: 8 bit cameras are CHAR waveforms, deeper ones SHORT waveforms
+        # of the unsigned pixels (see image_pv_value), half the size and conversion work of LONG.
+        max_image_size = int(values[0]*values[1])
+        image_dtype = self.image_dtype(values[2])
+        # Untouched zeros aren't paged in, and a read-only array isn't copied by the channels.
+        blank = self.image_pv_value(np.zeros(np.prod(self.roi_shape(values)), dtype=image_dtype))
+        blank.flags.writeable = False
+        image_route = ByteRoute if image_dtype == np.uint8 else ShortRoute
+        image_name = screenProps['image_name']
+        self.image2dev[image_name] = devName
+        self[image_name] = image_route(image_name, self.get_image, value=blank, max_length=max_image_size)
+        self[devName + ':IMG_BUF'] = image_route(devName + ':IMG_BUF', None, value=blank, max_length=max_image_size)
+        self.add_pvs(ProfMonPV(devName, self, prefix=devName))
+
+    def initialize_deadbands(self):
+        """ Per-screen deadbands, and the last published beam (x, y, beta_a, beta_b, e) for each screen. """
+        self.screen_index = {device_name: i for i, device_name in enumerate(self.profiles)}
+        self.position_deadbands = np.full(len(self.profiles), self.position_deadband)
+        self.relative_deadbands = np.full(len(self.profiles), self.relative_deadband)
+        self.last_beam = np.full((len(self.profiles), 5), np.nan)
+        self.suppressed_count = 0
+        self.updated_screens = set()
+
+    def beam_changed(self, index, beam):
+        """
+        Check new beam parameters for the screens at index against their deadbands,
+        all at once.  Returns a mask of the screens that need a new image.
+        """
+        last = self.last_beam[index]
+        delta = np.abs(beam - last)
+        position_deadbands = self.position_deadbands[index]
+        relative_deadbands = self.relative_deadbands[index]
+        # Comparisons with NaN are False, so a screen that has never been published is always changed.
+        within = np.all(delta[:, :2] <= position_deadbands[:, None], axis=1) & \
+                 np.all(delta[:, 2:] <= relative_deadbands[:, None] * np.abs(last[:, 2:]), axis=1)
+        changed = (position_deadbands < 0) | (relative_deadbands < 0) | ~within
+        self.last_beam[index[changed]] = beam[changed]
+        self.suppressed_count += len(changed) - np.count_nonzero(changed)
+        return changed
+
+    def initialize_render_pool(self):
+        """
+        Images are rendered in a pool of worker processes, one per available core.
+        Each screen has a shared-memory frame buffer that workers render straight into.
+        """
+        try:
+            n_workers = len(os.sched_getaffinity(0))
+        except AttributeError:
+            n_workers = os.cpu_count() or 1
+        # Spawned, not forked: this process has zmq and asyncio threads by the time the pool starts.
+        self.render_pool = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                                               initializer=init_render_worker)
+        self.frame_buffers = {}
+        self.frame_rings = {}
+        self.frame_lengths = {}
+        self.frame_counts = {}
+        for devName, profile in self.profiles.items():
+            values = profile['props']['values']
+            n_pixels = int(values[0]*values[1]) or self.default_image_dim**2
+            self.frame_buffers[devName] = shared_memory.SharedMemory(create=True, size=n_pixels*np.dtype(np.uint16).itemsize)
+            self.frame_lengths[devName] = np.zeros(self.frame_buffer_length, dtype=int)
+            self.frame_counts[devName] = 0
+        self.detector_buffers = {}
+        self.latest_beam = {}
+        self.stale_screens = set()
+        self.frame_requested = {devName: asyncio.Event() for devName in self.profiles}
+        self.frame_waiters = {}
+        self.frame_cache = OrderedDict()
+        self.frame_cache_bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.last_read = {}
+        atexit.register(self.release_frame_buffers)
+        L.info("Rendering images with %d worker processes.", n_workers)
+
+    def release_frame_buffers(self):
+        """ Stop the render workers and free the shared memory.  Safe to call more than once. """
+        self.render_pool.shutdown(wait=False, cancel_futures=True)
+        frame_buffers = list(self.frame_buffers.values()) + list(self.detector_buffers.values())
+        self.frame_buffers.clear()
+        self.detector_buffers.clear()
+        for frame_buffer in frame_buffers:
+            frame_buffer.close()
+            try:
+                frame_buffer.unlink()
+            except FileNotFoundError:
+                pass
+
+    async def render(self, devName, beamProps, img_type, cache=True):
+        """
+        Render a screen's image in the worker pool, or take it from the frame cache, and publish it.
+        Frames that are different every time (acquisition frames) skip the cache.
+        """
+        camProps = self.profiles[devName]['props']['values'].copy()
+        detector_name = self.detector_maps(devName) if self.detector_noise else None
+        key = self.frame_cache_key(devName, beamProps, camProps, img_type) if cache else None
+        if key in self.frame_cache:
+            self.cache_hits += 1
+            self.frame_cache.move_to_end(key)
+            image = self.buffer_frame(devName, self.frame_cache[key])
+            render_time = 0.0
+        else:
+            self.cache_misses += key is not None
+            start = time.perf_counter()
+            try:
+                shape, dtype, render_time = await asyncio.get_running_loop().run_in_executor(self.render_pool, render_to_shared_memory,
+                                                                                          self.frame_buffers[devName].name, beamProps, camProps, img_type,
+                                                                                          detector_name)
+            except Exception as e:
+                L.error("Rendering %s failed: %s", devName, e)
+                return
+            image = self.buffer_frame(devName, np.ndarray(shape, dtype=dtype, buffer=self.frame_buffers[devName].buf))
+            if key is not None:
+                # Ring slots get reused, so the cache keeps its own copy.
+                self.cache_frame(key, image.copy())
+            L.debug("Rendered %s in %.3f seconds, %.3f seconds after it was requested.", devName, render_time, time.perf_counter() - start)
+        self.profiles[devName]['image'] = image
+        self.profiles[devName]['render_time'] = render_time
+        self.updated_screens.add(devName)
+        await self.publish_profiles()
+
+    def detector_maps(self, devName):
+        """
+        A screen's static detector maps, made on first use: gain (float16) and dark background
+        (uint16) for every pixel of the sensor, in shared memory for the render workers.  Dead
+        pixels get no gain, hot pixels a saturated background, so one multiply-add applies it all.
+        """
+        if devName not in self.detector_buffers:
+            values = self.profiles[devName]['props']['values']
+            n_pixels = int(values[0]*values[1])
+            full_scale = 2**int(values[2]) - 1
+            rng = np.random.default_rng([self.detector_seed, zlib.crc32(devName.encode())])
+            maps = shared_memory.SharedMemory(create=True, size=n_pixels*4)
+            gain = np.ndarray(n_pixels, dtype=np.float16, buffer=maps.buf)
+            background = np.ndarray(n_pixels, dtype=np.uint16, buffer=maps.buf, offset=n_pixels*2)
+            gain[:] = rng.normal(1, self.gain_variation, n_pixels)
+            background[:] = np.clip(rng.normal(self.dark_level, self.dark_variation, n_pixels)*full_scale, 0, full_scale)
+            dead = rng.choice(n_pixels, rng.binomial(n_pixels, self.dead_pixel_fraction), replace=False)
+            gain[dead] = 0
+            background[dead] = 0
+            background[rng.choice(n_pixels, rng.binomial(n_pixels, self.hot_pixel_fraction), replace=False)] = full_scale
+            self.detector_buffers[devName] = maps
+        return self.detector_buffers[devName].name
+
+    def frame_ring(self, devName):
+        """
+        A screen's ring of recent frames, one array of frame_buffer_length sensor-sized frames,
+        made on its first frame so screens nobody renders hold no ring at all.
+        """
+        if devName not in self.frame_rings:
+            values = self.profiles[devName]['props']['values']
+            n_pixels = int(values[0]*values[1]) or self.default_image_dim**2
+            self.frame_rings[devName] = np.zeros((self.frame_buffer_length, n_pixels), dtype=self.image_dtype(values[2]))
+        return self.frame_rings[devName]
+
+    def buffer_frame(self, devName, frame):
+        """
+        Copy a frame into the screen's ring and return a read-only view of it there, which the image
+        PV serves without another copy.  While :SAVE_IMG is set the ring is held, and frames get
+        their own copy instead.
+        """
+        if self[devName + ':SAVE_IMG'].value:
+            image = frame.copy()
+        else:
+            ring = self.frame_ring(devName)
+            slot = self.frame_counts[devName] % len(ring)
+            ring[slot, :frame.size] = frame
+            self.frame_lengths[devName][slot] = frame.size
+            self.frame_counts[devName] += 1
+            image = ring[slot, :frame.size]
+        image.flags.writeable = False
+        return image
+
+    async def select_buffered_frame(self, devName, value):
+        """
+        Put a buffered frame on :IMG_BUF.  Frames are numbered like :IMG_BUF_IDX, counting up from 1;
+        zero or less counts back from the newest frame.
+        """
+        count = self.frame_counts[devName]
+        number = int(value) if value > 0 else count + int(value)
+        if not max(count - self.frame_buffer_length, 0) < number <= count:
+            raise ValueError("Frame {} of {} is not in the buffer.".format(number, devName))
+        ring = self.frame_ring(devName)
+        slot = (number - 1) % len(ring)
+        await self[devName + ':IMG_BUF'].write(self.image_pv_value(ring[slot, :self.frame_lengths[devName][slot]].copy()))
+        return value
+
+    def jitter_beam(self, beamProps, img_type):
+        """ One frame's beam: the model beam, moved by frame_jitter in x and y. """
+        dx, dy = self.rng.normal(0, self.frame_jitter, 2)
+        if img_type == "positions":
+            return {'particlePos': np.asarray(beamProps['particlePos']) + 1e-3*np.array([dx, dy])}
+        return dict(beamProps, x=beamProps['x'] + dx, y=beamProps['y'] + dy)
+
+    def frame_cache_key(self, devName, beamProps, camProps, img_type):
+        """
+        Screen, camera settings, noise model and quantized beam parameters, or None for beams
+        that aren't worth caching (particle positions) or can't be quantized (zero or non-finite).
+        """
+        if img_type == "positions":
+            return None
+        position = np.array([beamProps['x'], beamProps['y']])
+        scale = np.abs([beamProps['beta_a'], beamProps['beta_b'], beamProps['e']])
+        if not (np.isfinite(position).all() and np.isfinite(scale).all() and scale.all()):
+            return None
+        position = np.round(position/self.cache_position_quantum)
+        relative = np.round(np.log(scale)/self.cache_relative_quantum)
+        camera = tuple(camProps[self.cache_camera_props].tolist())
+        noise = tuple(getattr(self, name) for name in self.cache_noise_settings)
+        return (devName, img_type) + camera + noise + tuple(np.concatenate([position, relative]).astype(int).tolist())
+
+    def cache_frame(self, key, image):
+        """ Keep a rendered frame, evicting the least recently used frames to stay within frame_cache_size. """
+        if key is None or image.nbytes > self.frame_cache_size:
+            return
+        self.frame_cache[key] = image
+        self.frame_cache_bytes += image.nbytes
+        while self.frame_cache_bytes > self.frame_cache_size:
+            _, evicted = self.frame_cache.popitem(last=False)
+            self.frame_cache_bytes -= evicted.nbytes
+
+    def in_demand(self, devName):
+        """ Whether anyone is looking at a screen: monitoring or recently reading its image, or acquiring. """
+        image_name = self.profiles[devName]['props']['image_name']
+        if image_name not in self:
+            return False
+        queues = self[image_name]._queues
+        if any(sub_specs for syncs in queues.values() for by_type in syncs.values() for sub_specs in by_type.values()):
+            return True
+        if time.monotonic() - self.last_read.get(devName, -np.inf) < self.recent_read_period:
+            return True
+        return self.acquiring(devName)
+
+    def acquiring(self, devName):
+        acquire_name = devName + ':Acquisition'
+        return acquire_name in self and bool(self[acquire_name].value)
+
+    def subscriber_backlog(self, devName):
+        """ The longest queue of updates waiting to go out to subscribers of a screen's image. """
+        queues = self[self.profiles[devName]['props']['image_name']]._queues
+        return max((queue.qsize() for queue in queues), default=0)
+
+    def request_render(self, devName, beamProps, img_type):
+        """ Ask for a frame of a screen's newest beam if it's in demand, otherwise hold on to the beam until it is. """
+        self.latest_beam[devName] = (beamProps, img_type)
+        self.stale_screens.add(devName)
+        if self.in_demand(devName):
+            self.frame_requested[devName].set()
+
+    async def read_image(self, devName):
+        """ Bring a screen's image up to date before it is read. """
+        self.last_read[devName] = time.monotonic()
+        if devName in self.stale_screens:
+            waiter = asyncio.get_running_loop().create_future()
+            self.frame_waiters.setdefault(devName, []).append(waiter)
+            self.frame_requested[devName].set()
+            await waiter
+
+    async def get_image(self, image_name):
+        """ Getter for the image PVs.  Rendering publishes the image, so there's nothing to return. """
+        await self.read_image(self.image2dev[image_name])
+
+    async def render_on_demand(self):
+        """ Ask for frames of stale screens that somebody has started monitoring or acquiring since their beam changed. """
+        while True:
+            await asyncio.sleep(self.demand_check_period)
+            for devName in self.stale_screens:
+                if self.in_demand(devName):
+                    self.frame_requested[devName].set()
+
+    async def acquire_frames(self, devName):
+        """
+        A screen's acquisition loop: render the newest beam whenever a frame is asked for, or
+        continuously while :Acquisition is on, at most :FRAME_RATE times a second.  While the
+        image's subscribers are backed up it waits instead, so slow clients get fewer frames
+        rather than a growing queue.
+        """
+        loop = asyncio.get_running_loop()
+        frame_requested = self.frame_requested[devName]
+        frame_rate = self[devName + ':FRAME_RATE']
+        while True:
+            if not self.acquiring(devName) or devName not in self.latest_beam:
+                await frame_requested.wait()
+            frame_requested.clear()
+            start = loop.time()
+            while self.subscriber_backlog(devName) > self.max_frame_backlog:
+                await asyncio.sleep(self.backlog_poll_period)
+            self.stale_screens.discard(devName)
+            if devName in self.latest_beam:
+                beamProps, img_type = self.latest_beam[devName]
+                if self.acquiring(devName):
+                    await self.render(devName, self.jitter_beam(beamProps, img_type), img_type, cache=False)
+                else:
+                    await self.render(devName, beamProps, img_type)
+            if devName not in self.stale_screens:
+                for waiter in self.frame_waiters.pop(devName, []):
+                    if not waiter.done():
+                        waiter.set_result(None)
+            if frame_rate.value > 0:
+                await asyncio.sleep(start + 1/frame_rate.value - loop.time())
+
+    async def acquire(self):
+        """ Run every screen's acquisition loop, and the check for screens that have come into demand. """
+        screens = [devName for devName, profile in self.profiles.items() if profile['props']['image_name'] in self]
+        await asyncio.gather(self.render_on_demand(), *(self.acquire_frames(devName) for devName in screens))
+
+    def geometry_putter(self, devName, index):
+        async def put_geometry(pvname, value):
+            return await self.set_geometry(devName, index, value)
+        return put_geometry
+
+    async def set_geometry(self, devName, index, value):
+        """
+        Apply a binning or ROI setpoint, clamped to the sensor, and update the ROI readbacks.
+        The screen's latest beam is rendered again with the new geometry.
+        """
+        props = self.profiles[devName]['props']
+        values = props['values']
+        axis = index % 2
+        sensor = int(values[axis])
+        if index in (20, 21):
+            value = min(max(int(value), 0), sensor - 1)
+        else:
+            value = min(max(int(value), 1), sensor)
+        values[index] = value
+        values[4 + axis] = values[20 + axis]
+        values[6 + axis] = min(max(values[22 + axis], 1), sensor - values[20 + axis])
+        for readback in (4 + axis, 6 + axis):
+            if props['props'][readback] in self:
+                await self[props['props'][readback]].write(float(values[readback]))
+        if devName in self.latest_beam:
+            self.request_render(devName, *self.latest_beam[devName])
+        return float(value)
+
+    @staticmethod
+    def roi_shape(camProps):
+        """ Rows and columns of a camera's binned ROI. """
+        return int(camProps[7])//max(int(camProps[19]), 1), int(camProps[6])//max(int(camProps[18]), 1)
+
     def request_profiles(self):
         self.cmd_socket.send_pyobj({"cmd": "send_profiles_twiss"})
         return self.cmd_socket.recv_pyobj()
@@ -122,27 +567,21 @@ class ProfMonService(simulacrum.Service):
                     if devName not in self.profiles:
                         continue
                     beamProps = { 'particlePos': screens[screen]}
-                    image = self.gen_beam_image(beamProps, self.profiles[devName]['props']['values'], img_type="positions")
-                    self.profiles[devName]['image'] = image.tolist()
+                    self.request_render(devName, beamProps, "positions")
             elif md.get("tag", None) == "prof_data" and particles == False:
                 msg ="Profile data incoming: {}".format(md)
                 L.info(msg)
                 msg = await model_broadcast_socket.recv(flags=flags, copy=copy, track=track)
                 buf = memoryview(msg)
-                A = np.frombuffer(buf, dtype=md['dtype'])
-                result = np.rot90(A.reshape(md['shape']))
-                for i in range(result.shape[0]):
-                    orbit_x, orbit_y, beta_a, beta_b, e, name  = result[i]
-                    L.debug(beta_a)
-                    L.debug(beta_b)
-                    L.debug(name)
-                    devName = self.ele2dev[name]
-                    if devName not in self.profiles:
-                        continue
+                prof_data = np.frombuffer(buf, dtype=np.dtype(md['dtype'])).reshape(md['shape'])
+                rows = [i for i, name in enumerate(prof_data['name']) if self.ele2dev.get(name) in self.profiles]
+                devNames = [self.ele2dev[prof_data['name'][i]] for i in rows]
+                beam = np.column_stack([prof_data[field][rows] for field in ('x', 'y', 'beta_a', 'beta_b', 'e_tot')])
+                changed = self.beam_changed(np.array([self.screen_index[devName] for devName in devNames], dtype=int), beam)
+                for devName, (orbit_x, orbit_y, beta_a, beta_b, e) in zip(np.array(devNames)[changed], beam[changed]):
                     #CGI
-                    beamProps = {'beta_a': float(beta_a), 'beta_b': float(beta_b), 'x': float(orbit_x), 'y': float(orbit_y), 'e': float(e)}
-                    image = self.gen_beam_image(beamProps, self.profiles[devName]['props']['values'], img_type = "not_smooth")
-                    self.profiles[devName]['image'] = image.tolist()
+                    beamProps = {'beta_a': beta_a, 'beta_b': beta_b, 'x': orbit_x, 'y': orbit_y, 'e': e}
+                    self.request_render(devName, beamProps, "not_smooth")
             else: 
                 md = await model_broadcast_socket.recv(flags=flags, copy=copy, track=track)
                 
@@ -170,32 +609,49 @@ class ProfMonService(simulacrum.Service):
             await self.publish_profiles()
 
     async def publish_profiles(self):
-        for key, profile in self.profiles.items():
+        updated_screens, self.updated_screens = self.updated_screens, set()
+        for key in updated_screens:
+            profile = self.profiles[key]
             pvName = profile['props']['image_name']
             if pvName in self:
                 try:
-                    await self[pvName].write(profile['image'])
+                    await self[pvName].write(self.image_pv_value(profile['image']))
+                    await self[key+':SIM_RENDER_TIME'].write(profile['render_time'])
+                    await self[key+':IMG_BUF_IDX'].write(self.frame_counts[key])
                 except:
                     continue
+        await self.stats_pvs.suppressed.write(self.suppressed_count)
+        if self.cache_hits + self.cache_misses:
+            await self.stats_pvs.cache_hit_ratio.write(self.cache_hits/(self.cache_hits + self.cache_misses))
+        await self.stats_pvs.cache_bytes.write(self.frame_cache_bytes)
+        await self.stats_pvs.cache_frames.write(len(self.frame_cache))
 
     # Generate 2D gaussian from orbit & betas.
-    def gen_beam_image(self, beamProps, camProps, img_type = "smooth"):
+    def gen_beam_image(self, beamProps, camProps, img_type = "smooth", shot_noise = None, detector = None):
 
         # image parameters
         imageX = camProps[0]
         imageY = camProps[1]
         bit_depth = camProps[2]
         cal = (camProps[3]*1e-6 if camProps[3] else 1e-5)   # resolution ie  calibration in m/pixel  
+        minX = camProps[4]
+        minY = camProps[5]
         roiX = camProps[6]
         roiY = camProps[7]
+        binX = max(int(camProps[18]), 1)
+        binY = max(int(camProps[19]), 1)
         centerX = camProps[10]
         centerY = camProps[11]
         if(roiX*roiY == 0): 
             roiX = imageX
             roiY = imageY
         if(centerX== 0 or centerY == 0):
-            centerX = roiX/2
-            centerY = roiY/2
+            centerX = imageX/2
+            centerY = imageY/2
+        # Pixel edges in sensor pixels from the reticle center.  Only the ROI is rendered,
+        # and each binned pixel spans binX by binY sensor pixels.
+        x_edges = minX + 0.5 + binX*np.arange(int(roiX)//binX + 1) - centerX
+        y_edges = minY + 0.5 + binY*np.arange(int(roiY)//binY + 1) - centerY
 
         #Estimate camera intensity, see profmon_simulCreate.m. basically # of e- * quantum efficiency / attenuation factor
         q = .2e-9
@@ -211,17 +667,7 @@ class ProfMonService(simulacrum.Service):
             px = pos[0]/cal
             py = pos[1]/cal
             n_part = len(py)
-            if(n_part < 1e4):
-                px = px + centerX
-                py = py + centerY
-                img = intensity*self.KDEimage(px, py, int(roiX), int(roiY))
-            else:
-                x = np.arange(1, roiX+1) - centerX
-                y = np.arange(1, roiY+1) - centerY 
-                x = np.append(x - 0.5, x[-1]+0.5)
-                y = np.append(y - 0.5, y[-1]+0.5)
-                (h, _,_) = np.histogram2d(py, px, bins = (y, x))
-                img = intensity/n_part*h
+            img = intensity/max(n_part, 1)*self.KDEimage(px/binX, py/binY, x_edges/binX, y_edges/binY)
             #print(img)
         else:
             beta_a, beta_b, x, y, e = beamProps['beta_a'], beamProps['beta_b'], beamProps['x'], beamProps['y'], beamProps['e']
@@ -238,45 +684,150 @@ class ProfMonService(simulacrum.Service):
             A = 1./np.pi/sig_x/sig_y
             n_part = int(1e6)
             #generate image. TODO: get particle orbit and offset in x and y
-            x = np.arange(1, roiX+1) - centerX - xPos
-            y = np.arange(1, roiY+1) - centerY - yPos
+            x_edges = x_edges - xPos
+            y_edges = y_edges - yPos
             if(img_type == "smooth"):
-                x2 = -((x/sig_x)**2)/2
-                y2 = -((y/sig_y)**2)/2
+                x2 = -(((x_edges[:-1] + x_edges[1:])/2/sig_x)**2)/2
+                y2 = -(((y_edges[:-1] + y_edges[1:])/2/sig_y)**2)/2
                 xx2, yy2 = np.meshgrid(x2, y2)
-                img = intensity*A*np.exp(xx2 + yy2)
+                img = intensity*A*np.exp(xx2 + yy2)*binX*binY
             else:
-                px = np.random.normal(0, sig_x, n_part)
-                py = np.random.normal(0, sig_y, n_part)
-                x = np.append(x - 0.5, x[-1]+0.5)
-                y = np.append(y - 0.5, y[-1]+0.5)
-                (h, _,_) = np.histogram2d(py, px, bins = (y, x))
-                img = intensity/n_part*h
-        img = img.astype(np.uint8) if bit_depth <= 8 else img.astype(np.uint16) 
-        img_flat = np.minimum(img.ravel(), 2**bit_depth - 1) 
-        return img_flat
+                # The Gaussian integrated exactly over each pixel.  It's separable, so that's
+                # one error function difference per column and per row, and an outer product.
+                img = intensity*np.outer(self.pixel_fractions(y_edges, sig_y), self.pixel_fractions(x_edges, sig_x))
+                if self.shot_noise if shot_noise is None else shot_noise:
+                    img = intensity/n_part*self.rng.poisson(img*(n_part/intensity))
+        if detector is not None:
+            # Gain, background and readout noise for the ROI, applied in place.
+            gain, background, noise = detector
+            np.multiply(img, gain, out=img)
+            img += background
+            img += noise.reshape(img.shape)
+        img_flat = np.clip(img.ravel(), 0, 2**int(bit_depth) - 1)
+        return img_flat.astype(self.image_dtype(bit_depth))
+
+    @staticmethod
+    def image_dtype(bit_depth):
+        return np.uint8 if bit_depth <= 8 else np.uint16
+
+    @staticmethod
+    def image_pv_value(image):
+        """
+        What an image PV holds for a frame: the frame itself, or for 16 bit pixels a view of them
+        as the signed shorts CA carries, without a copy.  Clients read them back as unsigned, as
+        from an areaDetector IOC; up to 15 bits they're the same either way.
+        """
+        return image.view(np.int16) if image.dtype == np.uint16 else image
+
+    @staticmethod
+    def pixel_fractions(edges, sigma):
+        """Fraction of a zero-mean Gaussian with width sigma that lands between each pair of pixel edges."""
+        return 0.5*np.diff(erf(edges/(np.sqrt(2)*sigma)))
     
-    def KDEimage(self, x, y, roiY, roiX):
-        xmin = int(x.min())
-        xmax = int(x.max())
-        ymin = int(y.min())
-        ymax = int(y.max())
-        X, Y = np.mgrid[xmin:xmax, ymin:ymax]
-        positions = np.vstack([X.ravel(), Y.ravel()])
-        values = np.vstack([x, y])
-        kernel = gaussian_kde(values)
-        Z = np.reshape(kernel(positions).T, X.shape)
-        img = np.zeros((roiX, roiY));
-        img[xmin:xmax, ymin:ymax] = Z
-        return img
+    def KDEimage(self, x, y, x_edges, y_edges):
+        """
+        Binned kernel density estimate of particles at x, y: a histogram on the pixel grid,
+        smoothed by FFT convolution with a Gaussian kernel.  The kernel covariance is Scott's
+        rule, like scipy's gaussian_kde, so the cost is the histogram plus one FFT at any
+        number of particles.  Returns particles per pixel, rows along y.
+        """
+        h, _, _ = np.histogram2d(y, x, bins=(y_edges, x_edges))
+        n = len(x)
+        cov = np.cov(y, x)*n**(-1/3) if n > 1 else np.zeros((2, 2))
+        cov = cov + np.eye(2)*self.kde_min_bandwidth**2
+        half_width = np.minimum(np.ceil(4*np.sqrt(np.diag(cov))), h.shape).astype(int)
+        ky, kx = np.meshgrid(np.arange(-half_width[0], half_width[0]+1), np.arange(-half_width[1], half_width[1]+1), indexing='ij')
+        inv_cov = np.linalg.inv(cov)
+        kernel = np.exp(-0.5*(inv_cov[0, 0]*ky**2 + 2*inv_cov[0, 1]*ky*kx + inv_cov[1, 1]*kx**2))
+        # Convolve by FFT, zero padded so the image doesn't wrap around, and crop to the image.
+        shape = [next_fast_len(n + k - 1, real=True) for n, k in zip(h.shape, kernel.shape)]
+        smoothed = irfft2(rfft2(h, shape)*rfft2(kernel/kernel.sum(), shape), shape)
+        smoothed = smoothed[half_width[0]:half_width[0] + h.shape[0], half_width[1]:half_width[1] + h.shape[1]]
+        # FFT round-off can leave tiny negative values where there are no particles.
+        return np.maximum(smoothed, 0)
         
+_renderer = None
+_detector_maps = {}
+_detector_layers = {}
+_noise_banks = {}
+_noise_offset = 0
+
+def init_render_worker():
+    global _renderer
+    # Rendering only needs ProfMonService's class-level settings, not a whole service.
+    # Each worker gets its own random generator, so their shot noise isn't identical.
+    _renderer = ProfMonService.__new__(ProfMonService)
+    _renderer.rng = np.random.default_rng()
+
+def next_noise(n_pixels, sigma):
+    """
+    The next n_pixels draws from the worker's bank of readout noise with width sigma,
+    wrapping around at the end.  Banks are made on first use, one per sigma (bit depth).
+    """
+    global _noise_offset
+    if sigma not in _noise_banks:
+        _noise_banks[sigma] = _renderer.rng.normal(0, sigma, ProfMonService.noise_bank_size).astype(np.float32)
+    bank = _noise_banks[sigma]
+    start = _noise_offset % len(bank)
+    _noise_offset = (start + n_pixels) % len(bank)
+    if start + n_pixels <= len(bank):
+        return bank[start:start + n_pixels]
+    return np.take(bank, np.arange(start, start + n_pixels), mode='wrap')
+
+def detector_layers(maps_name, camProps):
+    """
+    Gain, background and this frame's readout noise for a camera's binned ROI.  Gain and
+    background come from the screen's shared sensor maps, and are kept per geometry: slices
+    of the maps without binning, binned copies (mean gain, summed background) with it.
+    """
+    key = (maps_name,) + tuple(camProps[[0, 1, 4, 5, 6, 7, 18, 19]])
+    if key not in _detector_layers:
+        if maps_name not in _detector_maps:
+            _detector_maps[maps_name] = shared_memory.SharedMemory(name=maps_name)
+        maps = _detector_maps[maps_name]
+        sensor = (int(camProps[1]), int(camProps[0]))
+        gain = np.ndarray(sensor, dtype=np.float16, buffer=maps.buf)
+        background = np.ndarray(sensor, dtype=np.uint16, buffer=maps.buf, offset=gain.nbytes)
+        rows, cols = ProfMonService.roi_shape(camProps)
+        bin_x, bin_y = max(int(camProps[18]), 1), max(int(camProps[19]), 1)
+        window = np.s_[int(camProps[5]):int(camProps[5]) + rows*bin_y, int(camProps[4]):int(camProps[4]) + cols*bin_x]
+        gain, background = gain[window], background[window]
+        if gain.shape != (rows*bin_y, cols*bin_x):
+            # An ROI hanging off the sensor has no detector model.
+            _detector_layers[key] = None
+        elif bin_x == bin_y == 1:
+            _detector_layers[key] = (gain, background)
+        else:
+            _detector_layers[key] = (gain.reshape(rows, bin_y, cols, bin_x).mean(axis=(1, 3), dtype=np.float32),
+                                     background.reshape(rows, bin_y, cols, bin_x).sum(axis=(1, 3), dtype=np.float32))
+    if _detector_layers[key] is None:
+        return None
+    gain, background = _detector_layers[key]
+    full_scale = 2**int(camProps[2]) - 1
+    return gain, background, next_noise(gain.size, ProfMonService.readout_noise*full_scale)
+
+def render_to_shared_memory(shm_name, beamProps, camProps, img_type, detector_name=None):
+    """Render one image in a worker process, into the screen's shared-memory frame buffer."""
+    start = time.perf_counter()
+    detector = detector_layers(detector_name, camProps) if detector_name else None
+    image = _renderer.gen_beam_image(beamProps, camProps, img_type=img_type, detector=detector)
+    frame_buffer = shared_memory.SharedMemory(name=shm_name)
+    try:
+        np.ndarray(image.shape, dtype=image.dtype, buffer=frame_buffer.buf)[:] = image
+    finally:
+        frame_buffer.close()
+    return image.shape, image.dtype.str, time.perf_counter() - start
+
 def main():
+    # Exit normally on SIGTERM too, so the render pool and shared frame buffers get cleaned up.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     service = ProfMonService()
     loop = asyncio.get_event_loop()
     _, run_options = ioc_arg_parser(
         default_prefix='',
         desc="Simulated Profile Monitor Service")
     loop.create_task(service.recv_profiles())
+    loop.create_task(service.acquire())
     loop.call_soon(service.request_profiles)
     run(service, **run_options)
     
@@ -324,6 +324,24 @@ class KlystronPV(PVGroup):
             await self.ampl.write(0.0)
         self.change_callback(self, is_on, "IS_ON")
 
+class KlystronSectorPV(PVGroup):
+    """
+    Trigger control for a whole sector: writing BEAMCODE1_TCTL writes it
+    to every klystron in the sector, and their model updates go out together.
+    """
+    bc1_tctl = pvproperty(value=0, name=':BEAMCODE1_TCTL', dtype=ChannelType.ENUM,
+                          enum_strings=("Deactivate", "Reactivate", "Activate"))
+    def __init__(self, klystron_pvs, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.klystron_pvs = klystron_pvs
+        self.bc1_tctl._data['value'] = 1
+
+    @bc1_tctl.putter
+    async def bc1_tctl(self, instance, value):
+        for klystron_pv in self.klystron_pvs:
+            await klystron_pv.bc1_tctl.write(value)
+        return value
+
 def _parse_klys_table(table):
     splits = [row.split() for row in table]
     return {'KLYS:LI{0}:{1}1'.format(ele_name[3:5],ele_name[6:8]): ( float(bmadEnld), float(bmadPhas), float(bmadEnld) > 1 ) for (_, ele_name, _, _, _, bmadEnld, bmadPhas) in splits}
@@ -345,21 +363,38 @@ def _parse_cudklys_table(table):
 
 class KlystronService(simulacrum.Service):
     attr_for_klys_type = {"ENLD": "ENLD_MeV", "PHAS":"PHAS_Deg"} 
+    # Klystron changes are queued, and sent to the model as one tao_batch a
+    # moment later, so a burst of changes (a whole sector, an energy profile)
+    # is one transaction, and the putters never wait on the model.
+    flush_delay = 0.05
+    # After a failed batch, the wait before the retry doubles, up to this.
+    max_flush_delay = 5.0
     def __init__(self):
         super().__init__()
         self.ctx = Context.instance()
         #cmd socket is a synchronous socket, we don't want the asyncio context.
         self.cmd_socket = zmq.Context().socket(zmq.REQ)
         self.cmd_socket.connect("tcp://127.0.0.1:{}".format(os.environ.get('MODEL_PORT', 12312)))
+        #model updates go through an asyncio socket, so they don't block the event loop.
+        self.model_socket = self.ctx.socket(zmq.REQ)
+        self.model_socket.connect("tcp://127.0.0.1:{}".format(os.environ.get('MODEL_PORT', 12312)))
+        self.pending_commands = {}
+        self.flush_task = None
+        self.retry_delay = self.flush_delay
         init_vals, init_cud_vals = self.get_klystron_ACTs_from_model()
         init_sbst_vals = self.get_sbst_ACTs_from_model()
         klys_pvs = {device_name: KlystronPV(device_name, convert_device_to_element(device_name), self.on_klystron_change, initial_values=init_vals[device_name], prefix=device_name) for device_name in init_vals.keys()}
         cud_pvs = {device_name: CudKlys(device_name,convert_device_to_element(device_name), initial_value=init_cud_vals[device_name], prefix=device_name) for device_name in init_cud_vals.keys()}
         sbst_pvs =  {device_name: SubboosterPV(device_name,convert_sbst_to_element(device_name), prefix=device_name) for device_name in init_sbst_vals.keys()}
+        sectors = {}
+        for device_name, klys_pv in klys_pvs.items():
+            sectors.setdefault(device_name.split(':')[1], []).append(klys_pv)
+        sector_pvs = {sector: KlystronSectorPV(klystron_pvs, prefix='KLYS:{}:ALL'.format(sector)) for sector, klystron_pvs in sectors.items()}
         L.info(init_vals)
         self.add_pvs(klys_pvs)
         self.add_pvs(cud_pvs)
         self.add_pvs(sbst_pvs)
+        self.add_pvs(sector_pvs)
         L.info("Initialization complete.")
 
     def get_klystron_ACTs_from_model(self):
@@ -391,11 +426,53 @@ class KlystronService(simulacrum.Service):
             value =  'T' if value else 'F'
             element = element[2:]+'*'  #O_K30_8 overlay to K30_8*
 
-        cmd = f'set ele {element} {klys_attr} = {value}'
-        L.info(cmd)
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": cmd})
-        msg = self.cmd_socket.recv_pyobj()['result']
-        L.info(msg)
+        # A newer change to the same attribute replaces a queued one.
+        self.pending_commands[(element, klys_attr)] = f'set ele {element} {klys_attr} = {value}'
+        if self.flush_task is None:
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        self.flush_task = asyncio.get_event_loop().create_task(self.flush())
+
+    async def flush(self):
+        """ Send queued klystron changes to the model, one batch at a time, until the queue is empty.
+        If a batch can't be sent, its commands go back on the queue and are retried, backing off
+        up to max_flush_delay while the model stays unreachable. """
+        batch = {}
+        cancelled = False
+        try:
+            while self.pending_commands:
+                await asyncio.sleep(self.retry_delay)
+                batch, self.pending_commands = self.pending_commands, {}
+                L.debug("Sending batch of %d commands to model.", len(batch))
+                await self.model_socket.send_pyobj({"cmd": "tao_batch", "val": list(batch.values())})
+                reply = await self.model_socket.recv_pyobj()
+                batch = {}
+                self.retry_delay = self.flush_delay
+                if reply['status'] != 'ok':
+                    L.error("Klystron update failed: %s", reply.get('err'))
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        except Exception as e:
+            L.error("Could not send klystron changes to the model: %s", e)
+        finally:
+            if batch:
+                # Changes queued while the batch was in flight are newer, so they win.
+                batch.update(self.pending_commands)
+                self.pending_commands = batch
+                self.reset_model_socket()
+                self.retry_delay = min(2 * self.retry_delay, self.max_flush_delay)
+            self.flush_task = None
+            # A cancelled flush (the service shutting down) must not start another one.
+            if self.pending_commands and not cancelled:
+                self.schedule_flush()
+
+    def reset_model_socket(self):
+        """ A REQ socket interrupted between send and recv can't be used again, so replace it. """
+        self.model_socket.close(linger=0)
+        self.model_socket = self.ctx.socket(zmq.REQ)
+        self.model_socket.connect("tcp://127.0.0.1:{}".format(os.environ.get('MODEL_PORT', 12312)))
    
 def main():
     service = KlystronService()
@@ -4,11 +4,13 @@ import asyncio
 import json
 import functools
 import math
+import time
+import numpy as np
 from collections import OrderedDict
 from caproto.server import ioc_arg_parser, run, pvproperty, PVGroup
 #from caproto.server.records import _Limits 
 from caproto.server.records.mixins import _Limits
-from caproto import ChannelType
+from caproto import AlarmStatus, AlarmSeverity, ChannelType
 import simulacrum
 import zmq
 from zmq.asyncio import Context
@@ -31,7 +33,9 @@ class MagnetPV(PVGroup):
     edes_save = pvproperty(value=0.0, name=':EDESSAVE')
     ctrl_strings = ("Ready", "TRIM", "PERTURB", "BCON_TO_BDES", "SAVE_BDES",
                     "LOAD_BDES", "UNDO_BDES", "DAC_ZERO", "CALB", "STDZ",
-                    "RESET", "TURN_ON", "TURN_OFF")                
+                    "RESET", "TURN_ON", "TURN_OFF", "DEGAUSS")
+    # Functions that move the magnet are handed to the service's ramp engine.
+    ramp_functions = ("TRIM", "PERTURB", "DAC_ZERO", "CALB", "STDZ", "TURN_ON", "TURN_OFF", "DEGAUSS")
     ctrl = pvproperty(value=0, name=':CTRL', dtype=ChannelType.ENUM,
                       enum_strings=ctrl_strings)
     func = pvproperty(value=0, name=':FUNC', dtype=ChannelType.ENUM,
@@ -50,21 +54,23 @@ class MagnetPV(PVGroup):
     bctrlegu = pvproperty(name=":BCTRL.EGU", read_only=True, dtype=ChannelType.STRING)
     bconegu = pvproperty(name=":BCON.EGU", read_only=True, dtype=ChannelType.STRING)
     
-    def __init__(self, device_name, element_name, change_callback, length, initial_value, read_only=False, *args, **kwargs):
+    def __init__(self, device_name, element_name, length, initial_value, read_only=False, state_callback=None, ctrl_callback=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.device_name = device_name
         self.element_name = element_name
         self.length = length
+        self.z = float(initial_value.get('z', 0.0))
+        self.state_callback = state_callback
+        self.ctrl_callback = ctrl_callback
         self.read_only = read_only
         self.saved_bdes = None
         self.bdes_for_undo = None
+        self.bend_string = None
         self.madname._data['value'] = element_name
         self.bcon._data['value'] = float(initial_value['bact'])
         self.bdes._data['value'] = float(initial_value['bact'])
         self.bact._data['value'] = float(initial_value['bact'])
         self.bctrl._data['value'] = float(initial_value['bact'])
-        if not read_only:
-            self.change_callback = change_callback
         if 'precision' in initial_value:
             prec = int(initial_value['precision'])
             self.bcon._data['precision'] = prec
@@ -106,15 +112,8 @@ class MagnetPV(PVGroup):
             L.info("Ignoring write to read-only magnet: %s", self.device_name)
             return 0
         ioc = instance.group
-        if value == "PERTURB":
-            await ioc.bact.write(ioc.bdes.value)
-            if self.change_callback:
-                await self.change_callback(self, ioc.bact.value)
-        elif value == "TRIM":
-            await asyncio.sleep(0.2)
-            await ioc.bact.write(ioc.bdes.value)
-            if self.change_callback:
-                await self.change_callback(self, ioc.bact.value)
+        if value in self.ramp_functions:
+            await self.ctrl_callback(self, value)
         elif value == "BCON_TO_BDES":
             await ioc.bdes.write(ioc.bcon.value)
         elif value == "SAVE_BDES":
@@ -129,6 +128,12 @@ class MagnetPV(PVGroup):
            L.warning("Warning, using a non-implemented magnet control function.")
         return 0
     
+    @abort.putter
+    async def abort(self, instance, value):
+        if value == "Abort" and self.ctrl_callback and not self.read_only:
+            await self.ctrl_callback(self, "ABORT")
+        return 0
+    
     @pvproperty(value=0.0, name=":BCTRL",record='ao')
     async def bctrl(self, instance):
         # We have to do some hacky stuff with caproto private data
@@ -164,6 +169,7 @@ class MagnetPV(PVGroup):
             return
         ioc = instance.group
         self.bdes_for_undo = ioc.bdes.value
+        self.notify_state_change("bdes", value)
         return value
     
     @bact.putter
@@ -171,29 +177,97 @@ class MagnetPV(PVGroup):
         ioc = instance.group
         self.bctrl._data['value'] = value
         await self.bctrl.publish(0)
+        self.notify_state_change("bact", value)
         return value
 
-def _parse_corr_table(table):
-    """ Build a dictionary of element_name -> (BACT)."""
-    # We use the 'tesla_to_kGm' function here for both bends and quads,
-    # even though quads actually just use kG units (not kG*m).
-    # This is because BMAD specifies quad strength as a gradient (T/m),
-    # so the math is the same for quads and bends.
-    splits = [row.split() for row in table]
-    return {simulacrum.util.convert_element_to_device(ele_name): {"length": float(l), "bact": bl_kick_to_BACT(float(bl_kick))} for (_, ele_name, _, _, l, bl_kick) in splits if ele_name in simulacrum.util.element_names}
+    def notify_state_change(self, attr, value):
+        if self.state_callback is not None:
+            self.state_callback(self, attr, value)
 
-def _parse_quad_table(table):
-    splits = [row.split() for row in table]
-    return {simulacrum.util.convert_element_to_device(ele_name): {"length": float(l), "bact": quad_gradient_to_BACT(float(b1_gradient), float(l))} for (_, ele_name, _, _, l, b1_gradient) in splits if ele_name in simulacrum.util.element_names}
+class MagnetGroupPV(PVGroup):
+    """ Service-level control for every magnet with :SELECT set to YES.
+    Writing a function here acts on all selected magnets at once, as one
+    batch in the ramp engine. """
+    ctrl = pvproperty(value=0, name=':CTRL', dtype=ChannelType.ENUM,
+                      enum_strings=("Ready", "TRIM", "PERTURB", "DAC_ZERO", "CALB", "STDZ",
+                                    "TURN_ON", "TURN_OFF", "DEGAUSS", "ABORT"))
+    nselected = pvproperty(value=0, name=':NSELECTED', read_only=True)
+
+    def __init__(self, ctrl_callback, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ctrl_callback = ctrl_callback
+
+    @ctrl.putter
+    async def ctrl(self, instance, value):
+        if value != "Ready":
+            await self.ctrl_callback(value)
+        return 0
 
-def _parse_multipole_table(table):
-    splits = [row.split() for row in table]
-    return {simulacrum.util.convert_element_to_device(ele_name): {"length": 0.0, "bact": multipole_K1L_to_BACT(float(k1l), float(p0c))} for (_, ele_name, _, _, _, k1l, p0c) in splits if ele_name in simulacrum.util.element_names}
+class MagnetArrayPV(PVGroup):
+    """ Machine-wide waveforms for every magnet of one type, ordered by z.
+    The arrays are updated element-by-element as individual magnets change,
+    and published a moment later so that a burst of changes results in a
+    single monitor update. Writing BDES applies all changes at once. """
+    names = pvproperty(value=[''], name=':NAMES', dtype=ChannelType.STRING, read_only=True)
+    bdes = pvproperty(value=[0.0], name=':BDES')
+    bact = pvproperty(value=[0.0], name=':BACT', read_only=True)
+    bmin = pvproperty(value=[0.0], name=':BMIN', read_only=True)
+    bmax = pvproperty(value=[0.0], name=':BMAX', read_only=True)
+    flush_delay = 0.05
+    
+    def __init__(self, magnet_pvs, bdes_callback, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.magnet_pvs = sorted(magnet_pvs, key=lambda magnet_pv: magnet_pv.z)
+        self.index = {magnet_pv.device_name: i for i, magnet_pv in enumerate(self.magnet_pvs)}
+        self.bdes_callback = bdes_callback
+        self.arrays = {attr: np.array([getattr(magnet_pv, attr).value for magnet_pv in self.magnet_pvs], dtype=float)
+                       for attr in ("bdes", "bact", "bmin", "bmax")}
+        self.dirty = set()
+        self.flush_task = None
+        # The waveform lengths are only known now, so we fix up caproto's
+        # private data rather than building a new class for every type.
+        n = len(self.magnet_pvs)
+        self.names._max_length = n
+        self.names._data['value'] = [magnet_pv.device_name for magnet_pv in self.magnet_pvs]
+        for attr, array in self.arrays.items():
+            getattr(self, attr)._max_length = n
+            getattr(self, attr)._data['value'] = array
+    
+    def update_element(self, attr, device_name, value):
+        self.arrays[attr][self.index[device_name]] = value
+        self.dirty.add(attr)
+        if self.flush_task is None:
+            self.flush_task = asyncio.get_event_loop().create_task(self.flush())
+    
+    async def flush(self):
+        await asyncio.sleep(self.flush_delay)
+        self.flush_task = None
+        dirty, self.dirty = self.dirty, set()
+        ts = time.time()
+        for attr in dirty:
+            await getattr(self, attr).write(self.arrays[attr], verify_value=False, timestamp=ts)
+    
+    @bdes.putter
+    async def bdes(self, instance, value):
+        value = np.asarray(value, dtype=float)
+        if len(value) != len(self.magnet_pvs):
+            raise ValueError("BDES waveform must have {} elements, got {}.".format(len(self.magnet_pvs), len(value)))
+        bmin, bmax = self.arrays['bmin'], self.arrays['bmax']
+        changed_mask = value != self.arrays['bdes']
+        if np.any(changed_mask & (bmin < bmax) & ((value < bmin) | (value > bmax))):
+            raise ValueError("BDES waveform exceeds magnet limits.")
+        changed = [self.magnet_pvs[i] for i in np.flatnonzero(changed_mask)
+                   if not self.magnet_pvs[i].read_only]
+        for magnet_pv in changed:
+            await magnet_pv.bdes.write(value[self.index[magnet_pv.device_name]])
+        if changed:
+            await self.bdes_callback(changed)
+        return self.arrays['bdes']
 
-def _parse_bend_table(table):
-    splits = [row.split() for row in table]
-    return {simulacrum.util.convert_element_to_device(ele_name): {"length": float(l), "bact": bend_b_field_to_BACT(float(b_field), float(l))} 
-        for (_, ele_name, _, _, l, b_field) in splits if ele_name in simulacrum.util.element_names}
+def load_magnet_limits():
+    path_to_limits_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "magnet_limits.json")
+    with open(path_to_limits_file) as f:
+        return json.load(f)
 
 def bl_kick_to_BACT(bl_kick, l=None):
     """Convert the bl_kick attribute (T*m) for a corrector into SLAC BACT compatible kG*m units"""
@@ -229,7 +303,157 @@ def bend_b_field_to_BACT(b_field, l):
     """Convert a BMAD b_field (T) into SLAC bend BACT (GeV/c)"""
     return -b_field*.11028748186*l
 
+class MagnetRampEngine:
+    """ Owns the BACT trajectory of every magnet.  Each magnet follows a list
+    of waypoints (one for a TRIM, several for a STDZ or DEGAUSS) at a
+    rate-limited slew.  A single timer task advances every moving magnet in
+    one vectorized step, and intermediate strengths are sent to the model at
+    a bounded rate, with a final update whenever a magnet arrives. """
+    tick_period = 0.1
+    model_update_period = 0.5
+    full_scale_ramp_time = 2.0
+    max_waypoints = 16
+    
+    def __init__(self, bact, bmin, bmax, send_to_model, publish, on_failure=None):
+        n = len(bact)
+        self.current = np.array(bact, dtype=float)
+        self.target = self.current.copy()
+        self.waypoints = np.zeros((n, self.max_waypoints))
+        self.n_waypoints = np.zeros(n, dtype=int)
+        self.next_waypoint = np.zeros(n, dtype=int)
+        self.moving = np.zeros(n, dtype=bool)
+        self.needs_model_update = np.zeros(n, dtype=bool)
+        # Ramp rate is set so that a full-scale move takes full_scale_ramp_time.
+        # Magnets without limits fall back to their present strength (or 1.0) as full scale.
+        full_scale = np.maximum(np.abs(bmin), np.abs(bmax))
+        full_scale = np.where(full_scale > 0, full_scale, np.maximum(np.abs(self.current), 1.0))
+        self.rate = full_scale / self.full_scale_ramp_time
+        self.send_to_model = send_to_model
+        self.publish = publish
+        self.on_failure = on_failure
+        self.waiters = []
+        self.last_model_update = 0.0
+    
+    def ramp(self, indices, trajectories):
+        """ Start moving magnets along new trajectories (one list of waypoints
+        per magnet).  Returns a future which completes once they all arrive. """
+        indices = np.asarray(indices, dtype=int)
+        for i, trajectory in zip(indices, trajectories):
+            trajectory = trajectory[-self.max_waypoints:]
+            self.waypoints[i, :len(trajectory)] = trajectory
+            self.n_waypoints[i] = len(trajectory)
+        self.next_waypoint[indices] = 0
+        self.target[indices] = self.waypoints[indices, 0]
+        self.moving[indices] = True
+        future = asyncio.get_event_loop().create_future()
+        self.waiters.append((indices, future))
+        return future
+    
+    async def jump(self, indices, values):
+        """ Move magnets to new values immediately, in one model transaction. """
+        indices = np.asarray(indices, dtype=int)
+        self.current[indices] = values
+        self.target[indices] = values
+        self.moving[indices] = False
+        self.needs_model_update[indices] = False
+        self.send_to_model(indices, self.current[indices])
+        await self.publish(indices, self.current[indices])
+        self.resolve_waiters()
+    
+    async def stop(self, indices):
+        """ Abort any motion, leaving magnets where they are right now. """
+        await self.jump(indices, self.current[indices])
+    
+    def resolve_waiters(self):
+        still_waiting = []
+        for indices, future in self.waiters:
+            if not self.moving[indices].any():
+                if not future.done():
+                    future.set_result(None)
+            else:
+                still_waiting.append((indices, future))
+        self.waiters = still_waiting
+    
+    async def step(self, dt):
+        idx = np.flatnonzero(self.moving)
+        delta = self.target[idx] - self.current[idx]
+        max_step = self.rate[idx] * dt
+        arrived = np.abs(delta) <= max_step
+        self.current[idx] = np.where(arrived, self.target[idx], self.current[idx] + np.sign(delta) * max_step)
+        # Magnets that reached a waypoint head for the next one, or stop.
+        reached = idx[arrived]
+        self.next_waypoint[reached] += 1
+        more = self.next_waypoint[reached] < self.n_waypoints[reached]
+        self.target[reached[more]] = self.waypoints[reached[more], self.next_waypoint[reached[more]]]
+        finished = reached[~more]
+        self.moving[finished] = False
+        self.needs_model_update[idx] = True
+        now = time.time()
+        if finished.size or now - self.last_model_update >= self.model_update_period:
+            update = np.flatnonzero(self.needs_model_update)
+            self.send_to_model(update, self.current[update])
+            self.needs_model_update[update] = False
+            self.last_model_update = now
+        await self.publish(idx, self.current[idx])
+        self.resolve_waiters()
+    
+    async def fail(self, indices, error):
+        """ Stop magnets whose step failed where they are, instead of retrying
+        them every tick, and fail any ramps still waiting on them. """
+        self.moving[indices] = False
+        self.target[indices] = self.current[indices]
+        self.needs_model_update[indices] = False
+        still_waiting = []
+        for waiting, future in self.waiters:
+            if np.isin(waiting, indices).any():
+                if not future.done():
+                    future.set_exception(error)
+            else:
+                still_waiting.append((waiting, future))
+        self.waiters = still_waiting
+        if self.on_failure:
+            await self.on_failure(indices)
+    
+    async def run(self):
+        last_tick = time.time()
+        while True:
+            await asyncio.sleep(self.tick_period)
+            now = time.time()
+            if self.moving.any():
+                idx = np.flatnonzero(self.moving)
+                try:
+                    await self.step(now - last_tick)
+                except Exception as e:
+                    L.error("Magnet ramp step failed, stopping %d magnets: %s", len(idx), e)
+                    try:
+                        await self.fail(idx, e)
+                    except Exception as e:
+                        L.error("Could not flag the stopped magnets: %s", e)
+            last_tick = now
+
 class MagnetService(simulacrum.Service):
+    group_prefix = "SIMULACRUM:SYS0:1:MAGNET"
+    # For each Bmad element key: the lat_list flags and Tao element list that select its magnets, the
+    # strength attributes to fetch, and how to convert them (plus length) into BACT.  Every conversion
+    # works on whole NumPy arrays.  The selection is the one 'show ele -no_slaves' and 'show lat' made:
+    # correctors named X* and Y*, every other magnet that isn't a slave, and bends by tracking element,
+    # since those are what make_bends knows how to group into strings.  Bends are converted in make_bends.
+    strength_attrs_for_key = {"hkicker": ("-no_slaves", "Hkicker::X*", ("bl_kick",), lambda l, bl_kick: bl_kick_to_BACT(bl_kick)),
+                              "vkicker": ("-no_slaves", "Vkicker::Y*", ("bl_kick",), lambda l, bl_kick: bl_kick_to_BACT(bl_kick)),
+                              "quadrupole": ("-no_slaves", "Quadrupole::*", ("b1_gradient",), lambda l, b1_gradient: quad_gradient_to_BACT(b1_gradient, l)),
+                              "multipole": ("-no_slaves", "Multipole::*", ("K1L", "p0c"), lambda l, k1l, p0c: multipole_K1L_to_BACT(k1l, p0c)),
+                              "sbend": ("-track_only", "Sbend::*", ("g", "b_field", "b_field_err"), None)}
+    stdz_cycles = 1
+    degauss_steps = 8
+    degauss_decay = 0.6
+    # Readback model parameters.  Noise, offset, and hysteresis are fractions of each magnet's full scale.
+    readback_noise = 1e-4
+    readback_offset = 1e-4
+    readback_hysteresis = 5e-4
+    readback_period = 0.5
+    readback_publish_limit = 200
+    readback_dtype = [('sigma', 'f8'), ('hysteresis', 'f8'), ('offset', 'f8'), ('branch', 'i1'),
+                      ('noise', 'f8'), ('bact', 'f8'), ('published', 'f8')]
     attr_for_mag_type = {"XCOR": "bl_kick", "YCOR": "bl_kick", "QUAD": "b1_gradient", "BEND": "b_field"}
     conversion_to_BMAD_for_mag_type = {"XCOR": BACT_to_bl_kick, "YCOR": BACT_to_bl_kick, "QUAD": quad_BACT_to_gradient, "BEND": bend_BACT_to_b_field}
     def __init__(self):
@@ -238,73 +462,270 @@ class MagnetService(simulacrum.Service):
         #cmd socket is a synchronous socket, we don't want the asyncio context.
         self.cmd_socket = zmq.Context().socket(zmq.REQ)
         self.cmd_socket.connect("tcp://127.0.0.1:{}".format(os.environ.get('MODEL_PORT', 12312)))
-        init_vals = self.get_initial_values()
-        magnet_element_list = self.get_magnet_list_from_model()
-        magnet_device_list = [simulacrum.util.convert_element_to_device(element) for element in magnet_element_list]
-        mag_pvs = {device_name: MagnetPV(device_name, simulacrum.util.convert_device_to_element(device_name), self.on_magnet_change, length=init_vals[device_name]['length'], initial_value=init_vals[device_name], prefix=device_name) 
-                    for device_name in magnet_device_list
-                    if device_name in init_vals}
+        start_time = time.time()
+        self.limits = load_magnet_limits()
+        magnet_data = self.get_magnet_data_from_model()
+        init_vals = self.get_initial_values(magnet_data)
+        model_time = time.time() - start_time
+        mag_pvs = {device_name: MagnetPV(device_name, simulacrum.util.convert_device_to_element(device_name), length=init_vals[device_name]['length'], initial_value=init_vals[device_name], state_callback=self.on_state_change, ctrl_callback=self.on_magnet_ctrl, prefix=device_name) 
+                    for device_name in init_vals}
         self.add_pvs(mag_pvs)
-        #print(init_vals.keys())
-
-        #print(mag_pvs.keys())
         # Lets do some custom additions to handle bend magnets.
-        self.add_pvs(self.make_bends())
+        bend_pvs = self.make_bends(magnet_data['sbend'])
+        self.add_pvs(bend_pvs)
+        self.magnet_pvs = dict(mag_pvs, **bend_pvs)
+        self.magnet_list = list(self.magnet_pvs.values())
+        self.magnet_index = {magnet_pv.device_name: i for i, magnet_pv in enumerate(self.magnet_list)}
+        self.ramp_engine = MagnetRampEngine([magnet_pv.bact.value for magnet_pv in self.magnet_list],
+                                            [magnet_pv.bmin.value for magnet_pv in self.magnet_list],
+                                            [magnet_pv.bmax.value for magnet_pv in self.magnet_list],
+                                            self.send_indices_to_model, self.publish_bacts, self.on_ramp_failure)
+        self.readback = self.initialize_readback_model()
+        self.readback_cursor = 0
+        self.group_pv = MagnetGroupPV(self.on_group_ctrl, prefix=self.group_prefix)
+        self.add_pvs(self.group_pv)
+        self.array_pvs = self.make_array_pvs()
+        self.add_pvs(self.array_pvs)
         
         # Now that we've set up all the magnets, we need to send the model a
         # command to use non-normalized magnetic field units.
         self.cmd_socket.send_pyobj({"cmd": "tao", "val": "set ele Hkicker::*,Vkicker::*,Quadrupole::*,Sbend::*,Multipole::* field_master = T"})
         self.cmd_socket.recv_pyobj()
-        L.info("Initialization complete.")
+        L.info("Initialization complete in %.2f seconds (%.2f seconds fetching from the model, %d magnets).",
+               time.time() - start_time, model_time, len(self.magnet_list))
         
-    def get_magnet_list_from_model(self):
-        element_list = []
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": "show ele -no_slaves Hkicker::*,Vkicker::*"})
-        l1 =  self.cmd_socket.recv_pyobj()['result'][:-1]
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": "show ele -no_slaves Quadrupole::*,Multipole::*"})
-        l2 =  self.cmd_socket.recv_pyobj()['result'][:-1]
-        for row in l1 + l2:
-            element_list.append(row.split(None, 3)[1])
-        #print(element_list)
-        return element_list
+    def lat_list(self, who, elements, flags="-no_slaves"):
+        """ Fetch one attribute for a list of elements from the model with
+        Tao's 'python lat_list'.  Real-valued attributes ('real:ele.s') come
+        back as a NumPy array, anything else as a list of strings. """
+        cmd = "python lat_list {flags} -index_order 1@0>>{elements}|model {who}".format(flags=flags, elements=elements, who=who)
+        self.cmd_socket.send_pyobj({"cmd": "tao_real" if who.startswith("real:") else "tao", "val": cmd})
+        return self.cmd_socket.recv_pyobj()['result']
+
+    def get_magnet_data_from_model(self):
+        """ Fetch name, position, length and strength attributes for every
+        magnet, with one array-returning query per element type and attribute.
+        Returns a dict, keyed on lowercase element key, of dicts of arrays. """
+        magnet_data = {}
+        for key, (flags, elements, attrs, _) in self.strength_attrs_for_key.items():
+            names = self.lat_list("ele.name", elements, flags)
+            magnet_data[key] = {"name": np.array(names, dtype=str)}
+            for field, attr in [("z", "s"), ("l", "l")] + [(attr, attr) for attr in attrs]:
+                magnet_data[key][field] = self.lat_list("real:ele.{}".format(attr), elements, flags) if names else np.zeros(0)
+        return magnet_data
     
-    def get_initial_values(self):
-        init_vals = self.get_magnet_BACTs_from_model()
-        path_to_limits_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "magnet_limits.json")
-        with open(path_to_limits_file) as f:
-            limits = json.load(f)
-            for device_name in init_vals:
+    def get_initial_values(self, magnet_data):
+        """ Build a dictionary of device_name -> (length, z, BACT, limits) for
+        every non-bend magnet, converting strengths a whole array at a time. """
+        init_vals = {}
+        for key, data in magnet_data.items():
+            _, _, attrs, to_BACT = self.strength_attrs_for_key[key]
+            if to_BACT is None or len(data["name"]) == 0:
+                continue
+            bact = to_BACT(data["l"], *[data[attr] for attr in attrs])
+            for element_name, z, l, b in zip(data["name"], data["z"], data["l"], bact):
                 try:
-                    init_vals[device_name]["units"] = limits[device_name]["EGU"]
-                    init_vals[device_name]["precision"] = limits[device_name]["PREC"]
-                    init_vals[device_name]["upper_ctrl_limit"] = limits[device_name]["HOPR"]
-                    init_vals[device_name]["lower_ctrl_limit"] = limits[device_name]["LOPR"]
+                    device_name = simulacrum.util.convert_element_to_device(element_name)
                 except KeyError:
-                    pass
-        return init_vals
-    
-    def get_magnet_BACTs_from_model(self):
-        init_vals = {}
-        for (attr, dev_list, parse_func) in [("bl_kick", "Hkicker::X*", _parse_corr_table), ("bl_kick", "Vkicker::Y*", _parse_corr_table), ("b1_gradient", "Quadrupole::* ", _parse_quad_table),  ("b_field", "Sbend::*", _parse_bend_table), ("K1L -attribute P0C", "Multipole::*", _parse_multipole_table)]:
-            self.cmd_socket.send_pyobj({"cmd": "tao", "val": "show lat -no_label_lines -attribute {attr} {list}".format(attr=attr, list=dev_list)})
-            table = self.cmd_socket.recv_pyobj()
-            init_vals.update(parse_func(table['result']))
+                    continue
+                init_vals[device_name] = {"length": float(l), "z": float(z), "bact": float(b)}
+                if device_name in self.limits:
+                    limits = self.limits[device_name]
+                    init_vals[device_name].update({"units": limits["EGU"], "precision": limits["PREC"],
+                                                   "upper_ctrl_limit": limits["HOPR"], "lower_ctrl_limit": limits["LOPR"]})
         return init_vals
 
-    async def on_magnet_change(self, magnet_pv, value):
-        """ This method gets called any time a PV updates for XCORs, YCORs, or QUADs. """
+    def model_command(self, magnet_pv, value):
+        """ Build the Tao command that sets a XCOR, YCOR, or QUAD to value (in EPICS units). """
         mag_type = magnet_pv.device_name.split(":")[0]
         mag_attr = self.attr_for_mag_type[mag_type]
         conv = self.conversion_to_BMAD_for_mag_type[mag_type]
         l = magnet_pv.length
-        L.debug('Updating {}... '.format(magnet_pv.device_name))
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": "set ele {element} {attr} = {val}".format(element=magnet_pv.element_name, 
-                                                                                                   attr=mag_attr,
-                                                                                                   val=conv(value, l))})
-        self.cmd_socket.recv_pyobj()
-        L.debug('Updated {}.'.format(magnet_pv.device_name))
+        return "set ele {element} {attr} = {val}".format(element=magnet_pv.element_name, 
+                                                          attr=mag_attr,
+                                                          val=conv(value, l))
+
+    def send_magnets_to_model(self, magnet_pvs, values):
+        """ Set a whole list of magnets in the model with a single batch command. """
+        commands = []
+        for magnet_pv, value in zip(magnet_pvs, values):
+            if magnet_pv.bend_string is not None:
+                commands.extend(magnet_pv.bend_string.field_strength_commands(value))
+                continue
+            try:
+                commands.append(self.model_command(magnet_pv, value))
+            except KeyError:
+                L.warning("Don't know how to set %s in the model, skipping it.", magnet_pv.device_name)
+        if not commands:
+            return
+        L.debug("Sending batch of %d commands to model.", len(commands))
+        self.cmd_socket.send_pyobj({"cmd": "tao_batch", "val": commands})
+        return self.cmd_socket.recv_pyobj()
+
+    def make_array_pvs(self):
+        """ Make one set of machine-wide waveform PVs per magnet type (QUAD, XCOR, etc). """
+        magnets_by_type = {}
+        for magnet_pv in self.magnet_pvs.values():
+            mag_type = magnet_pv.device_name.split(":")[0]
+            magnets_by_type.setdefault(mag_type, []).append(magnet_pv)
+        array_pvs = {mag_type: MagnetArrayPV(magnet_pvs, self.perturb_magnets, prefix="{}:{}".format(self.group_prefix, mag_type))
+                     for mag_type, magnet_pvs in magnets_by_type.items()}
+        self.array_pv_for_device = {magnet_pv.device_name: array_pv for array_pv in array_pvs.values() for magnet_pv in array_pv.magnet_pvs}
+        return array_pvs
+
+    async def perturb_magnets(self, magnet_pvs):
+        await self.apply_ctrl(magnet_pvs, "PERTURB")
+
+    def on_state_change(self, magnet_pv, attr, value):
+        """ Keep the machine-wide waveforms in sync with individual magnet PVs. """
+        array_pv = self.array_pv_for_device.get(magnet_pv.device_name)
+        if array_pv is not None:
+            array_pv.update_element(attr, magnet_pv.device_name, value)
+
+    def selected_magnets(self):
+        return [magnet_pv for magnet_pv in self.magnet_pvs.values()
+                if magnet_pv.select.value == "YES" and not magnet_pv.read_only]
+
+    async def on_group_ctrl(self, value):
+        """ Apply a group control function to every selected magnet.  Unlike
+        N individual TRIMs, the whole group shares one model transaction and
+        one settle time, and all the new BACTs are published together. """
+        selected = self.selected_magnets()
+        await self.group_pv.nselected.write(len(selected))
+        if not selected:
+            L.info("Group %s requested, but no magnets are selected.", value)
+            return
+        L.info("Group %s of %d magnets.", value, len(selected))
+        await self.apply_ctrl(selected, value)
+
+    async def on_magnet_ctrl(self, magnet_pv, value):
+        await self.apply_ctrl([magnet_pv], value)
+
+    async def apply_ctrl(self, magnet_pvs, value):
+        """ Run a magnet control function on a list of magnets as one batch in the ramp engine. """
+        if value not in ("TURN_ON", "ABORT"):
+            magnet_pvs = [magnet_pv for magnet_pv in magnet_pvs if magnet_pv.statmsg.value != "Turned Off"]
+        if not magnet_pvs:
+            return
+        indices = [self.magnet_index[magnet_pv.device_name] for magnet_pv in magnet_pvs]
+        bdes = [magnet_pv.bdes.value for magnet_pv in magnet_pvs]
+        if value == "PERTURB":
+            await self.ramp_engine.jump(indices, bdes)
+        elif value == "ABORT":
+            await self.ramp_engine.stop(indices)
+        elif value == "CALB":
+            L.info("Calibrated %d magnets.", len(magnet_pvs))
+        elif value == "TRIM":
+            await self.ramp_engine.ramp(indices, [[b] for b in bdes])
+        elif value in ("DAC_ZERO", "TURN_OFF"):
+            await self.ramp_engine.ramp(indices, [[0.0]] * len(indices))
+        elif value == "TURN_ON":
+            await self.ramp_engine.ramp(indices, [[b] for b in bdes])
+        elif value == "STDZ":
+            await self.ramp_engine.ramp(indices, [[magnet_pv.bmax.value, magnet_pv.bmin.value] * self.stdz_cycles + [b]
+                                                  for magnet_pv, b in zip(magnet_pvs, bdes)])
+        elif value == "DEGAUSS":
+            await self.ramp_engine.ramp(indices, [self.degauss_trajectory(magnet_pv) for magnet_pv in magnet_pvs])
+            # A degaussed magnet has no remanent field, so it sits on neither hysteresis branch.
+            self.readback['branch'][indices] = 0
+        # Only functions that move the magnet change its status: ABORT, CALB and the like leave it alone.
+        if value not in ("TRIM", "PERTURB", "DAC_ZERO", "STDZ", "TURN_ON", "TURN_OFF", "DEGAUSS"):
+            return
+        statmsg = "Turned Off" if value == "TURN_OFF" else "Good"
+        await asyncio.gather(*[magnet_pv.statmsg.write(statmsg) for magnet_pv in magnet_pvs
+                               if magnet_pv.statmsg.value != statmsg])
+        # A magnet that arrives has recovered from any earlier failed ramp.
+        await asyncio.gather(*[magnet_pv.bact.alarm.write(status=AlarmStatus.NO_ALARM, severity=AlarmSeverity.NO_ALARM)
+                               for magnet_pv in magnet_pvs if magnet_pv.bact.alarm.severity != AlarmSeverity.NO_ALARM])
+
+    async def on_ramp_failure(self, indices):
+        """ Flag magnets the ramp engine had to stop, until they next arrive somewhere. """
+        for i in indices:
+            magnet_pv = self.magnet_list[i]
+            await magnet_pv.statmsg.write("BAD BACT")
+            await magnet_pv.bact.alarm.write(status=AlarmStatus.COMM, severity=AlarmSeverity.MAJOR_ALARM)
+
+    def degauss_trajectory(self, magnet_pv):
+        """ An alternating, decaying sequence around zero, clipped to the
+        magnet's limits, that finishes at BDES. """
+        bmin, bmax = magnet_pv.bmin.value, magnet_pv.bmax.value
+        full_scale = max(abs(bmin), abs(bmax), abs(magnet_pv.bdes.value))
+        k = np.arange(self.degauss_steps)
+        trajectory = full_scale * (-self.degauss_decay) ** k
+        if bmin < bmax:
+            trajectory = np.clip(trajectory, bmin, bmax)
+        return list(trajectory) + [magnet_pv.bdes.value]
+
+    def initialize_readback_model(self):
+        """ Build the per-magnet readback model as one structured array, indexed
+        like self.magnet_list.  Read-only bend slaves just mirror their master. """
+        self.rng = np.random.default_rng()
+        readback = np.zeros(len(self.magnet_list), dtype=self.readback_dtype)
+        full_scale = np.array([0.0 if magnet_pv.read_only else max(abs(magnet_pv.bmin.value), abs(magnet_pv.bmax.value))
+                               for magnet_pv in self.magnet_list])
+        readback['sigma'] = self.readback_noise * full_scale
+        readback['hysteresis'] = self.readback_hysteresis * full_scale
+        readback['offset'] = self.rng.standard_normal(len(readback)) * self.readback_offset * full_scale
+        readback['bact'] = self.ramp_engine.current
+        readback['published'] = self.ramp_engine.current
+        return readback
+
+    def readback_values(self, indices):
+        rb = self.readback[indices]
+        return rb['bact'] + rb['offset'] + rb['branch'] * rb['hysteresis'] + rb['noise']
+
+    async def update_readbacks(self):
+        """ Draw new readback noise for every magnet in one vectorized step, then
+        publish at most readback_publish_limit of the changed BACTs per tick,
+        taking turns so the cost stays flat with the number of magnets. """
+        while True:
+            await asyncio.sleep(self.readback_period)
+            rb = self.readback
+            rb['noise'] = self.rng.standard_normal(len(rb)) * rb['sigma']
+            readbacks = rb['bact'] + rb['offset'] + rb['branch'] * rb['hysteresis'] + rb['noise']
+            changed = np.flatnonzero(readbacks != rb['published'])
+            if changed.size == 0:
+                continue
+            changed = np.roll(changed, -np.searchsorted(changed, self.readback_cursor))[:self.readback_publish_limit]
+            self.readback_cursor = changed[-1] + 1
+            try:
+                await self.write_bacts(changed, readbacks[changed])
+            except Exception as e:
+                L.error("Readback update failed: %s", e)
+
+    def send_indices_to_model(self, indices, values):
+        self.send_magnets_to_model([self.magnet_list[i] for i in indices], values)
+
+    async def publish_bacts(self, indices, values):
+        """ Publish a batch of new field values from the ramp engine, as seen
+        through the readback model.  The hysteresis branch follows the
+        direction each magnet last moved in. """
+        indices = np.asarray(indices, dtype=int)
+        rb = self.readback
+        direction = np.sign(values - rb['bact'][indices]).astype('i1')
+        rb['branch'][indices] = np.where(direction != 0, direction, rb['branch'][indices])
+        rb['bact'][indices] = values
+        await self.write_bacts(indices, self.readback_values(indices))
+        for i, val in zip(indices, values):
+            if self.magnet_list[i].bend_string is not None:
+                await self.magnet_list[i].bend_string.update_slave_pvs(val)
 
-    def make_bends(self):
+    async def write_bacts(self, indices, readbacks):
+        """ Write a batch of BACTs, all with the same timestamp. """
+        self.readback['published'][indices] = readbacks
+        ts = time.time()
+        await asyncio.gather(*[self.magnet_list[i].bact.write(val, timestamp=ts) for i, val in zip(indices, readbacks)])
+
+    async def startup(self, async_lib):
+        """
+        'startup_hook' coroutine, starts the magnet ramp engine and readback model timer tasks.
+        'async_lib' arg is a requirement of caproto, but this method only works for asyncio.
+        """
+        loop = asyncio.get_running_loop()
+        loop.create_task(self.ramp_engine.run())
+        loop.create_task(self.update_readbacks())
+
+    def make_bends(self, bend_data):
         """ Make PVs for all the bends.  This is a lengthy procedure due to the
         ridiculous complexity of how these are defined: bends are usually strings,
         different types of bends work differently, naming conventions aren't
@@ -355,21 +776,16 @@ class MagnetService(simulacrum.Service):
                     "BRSP1H": "BRSP1H", "BRSP2H":  "BRSP1H",
                     "BXSP1H": "BXSP1H",
                    }
-        # Get a list of all bends, and the attributes we need to use them.
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": "show lat -tracking_elements -no_label_lines -attribute g -attribute b_field -attribute b_field_err SBend::*"})
-        result = self.cmd_socket.recv_pyobj()
-        # Parse this list, make all the conversion factors, and create the magnet PVs for the bends.
+        # Parse the list of all bends, make all the conversion factors, and create the magnet PVs for the bends.
         # We store them in a 'bends' dictionary, keyed on the element name of the master bend.
         bends = {}
         master_bends = {}
-        for line in result['result']:
-            L.debug(line)
-            s = line.split()
-            element_name = s[1]
-            l = float(s[4]) # Length of the magnet (in meters)
-            g = float(s[5]) # g = 1/rho, where rho is bend radius.  g has units of 1/meter
-            b_init_tesla = float(s[6]) # The "design" magnetic field for the magnet, in tesla.
-            b_field_err_init = float(s[7]) # The "field error" for this magnet, in tesla.
+        for element_name, z, l, g, b_init_tesla, b_field_err_init in zip(bend_data["name"], bend_data["z"], bend_data["l"],
+                                                                         bend_data["g"], bend_data["b_field"], bend_data["b_field_err"]):
+            # l is the length of the magnet (in meters), z its position.
+            # g = 1/rho, where rho is bend radius.  g has units of 1/meter
+            # b_init_tesla is the "design" magnetic field for the magnet, in tesla.
+            # b_field_err_init is the "field error" for this magnet, in tesla.
             # Make a 'BendElement', which is usually half of a bend, for every item in this list.
             bend_type = None
             if element_name in chicane_bends:
@@ -385,7 +801,7 @@ class MagnetService(simulacrum.Service):
             if bend_type:
                 if master_bend_name not in bends:
                     bends[master_bend_name] = []
-                bend = Bend(element_name, l, g, b_init_tesla, b_field_err_init, bend_type)
+                bend = Bend(element_name, l, g, b_init_tesla, b_field_err_init, bend_type, z)
                 bends[master_bend_name].append(bend)
                 if element_name == master_bend_name:
                     master_bends[master_bend_name] = bend
@@ -397,25 +813,22 @@ class MagnetService(simulacrum.Service):
             # Determine the 'master' bend.
             master_bend = master_bends[string_name]
             L.debug("Making a string for {}.  Bend list: {}.  Master: {}".format(string_name, [bend.element_name for bend in bends_for_string], master_bend.element_name))
-            bend_strings.append(BendString(bends_for_string, master_bend, self.cmd_socket))
+            bend_strings.append(BendString(bends_for_string, master_bend))
         
         # Make all the PV objects.
-        path_to_limits_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "magnet_limits.json")
-        with open(path_to_limits_file) as f:
-            limits = json.load(f)
-            pvs = {}
-            for string in bend_strings:
-                pvs.update({bend_pv.device_name: bend_pv for bend_pv in string.make_pvs(limits)})
-            #print(pvs.keys())
-            return pvs
+        pvs = {}
+        for string in bend_strings:
+            pvs.update({bend_pv.device_name: bend_pv for bend_pv in string.make_pvs(self.limits, self.on_state_change, self.on_magnet_ctrl)})
+        return pvs
 
 class Bend:
     """ Represents one bend magnet.  Usually these are part of a string.
         One MagnetPV object is created for each bend magnet. """
-    def __init__(self, name, l, g, b_init_tesla, b_field_err_init, bend_type):
+    def __init__(self, name, l, g, b_init_tesla, b_field_err_init, bend_type, z=0.0):
         self.element_name = name
         self.device_name = simulacrum.util.convert_element_to_device(self.element_name)
         self.l = l
+        self.z = z
         self.g = g
         self.b_init_tesla = b_init_tesla
         self.b_field_err_init = b_field_err_init
@@ -457,8 +870,8 @@ class Bend:
             b_err = self.convert_to_b_field_err(b_field)
         return f"set ele {self.element_name} b_field_err = {b_err}"
     
-    def make_pv(self, read_only, precision=None, upper_ctrl_limit=None, lower_ctrl_limit=None, change_callback=None):
-        init_vals = {"bact": self.convert_tesla_to_epics_units(self.b_init_tesla), "units": self.unit}
+    def make_pv(self, read_only, precision=None, upper_ctrl_limit=None, lower_ctrl_limit=None, state_callback=None, ctrl_callback=None):
+        init_vals = {"bact": self.convert_tesla_to_epics_units(self.b_init_tesla), "units": self.unit, "z": self.z}
         if precision:
             init_vals["precision"] = precision
         if upper_ctrl_limit:
@@ -466,52 +879,47 @@ class Bend:
         if lower_ctrl_limit:
             init_vals["lower_ctrl_limit"] = lower_ctrl_limit
         L.debug("%s: Making PV.  Init Vals: %s", self.element_name, repr(init_vals))
-        self.pv = MagnetPV(self.device_name, self.element_name, change_callback, length=self.l, initial_value=init_vals, read_only=read_only, prefix=self.device_name)
+        self.pv = MagnetPV(self.device_name, self.element_name, length=self.l, initial_value=init_vals, read_only=read_only, state_callback=state_callback, ctrl_callback=ctrl_callback, prefix=self.device_name)
         return self.pv
         
 class BendString:
     """ Represents a whole string of bends.  This class is responsible for
         setting magnet strengths in the model. """
-    def __init__(self, bends, master, cmd_socket):
+    def __init__(self, bends, master):
         self.bends = bends
         self.master_bend = master
-        self.cmd_socket = cmd_socket
     
-    def send_field_strength_to_model(self, b_field_from_epics):
-        commands = []
+    def field_strength_commands(self, b_field_from_epics):
+        return [bend.set_field_strength_command(b_field_from_epics) for bend in self.bends]
+
+    async def update_slave_pvs(self, value):
         for bend in self.bends:
-            sub_command = bend.set_field_strength_command(b_field_from_epics)
-            commands.append(sub_command)
-        L.debug("Sending batch to model: {}".format(commands))
-        self.cmd_socket.send_pyobj({"cmd": "tao_batch", "val": commands})
-        return self.cmd_socket.recv_pyobj()
+            if bend != self.master_bend:
+                # Update all the non-master bend PVs, without triggering their callbacks.
+                bend.pv.bctrl._data['value'] = value
+                await bend.pv.bctrl.publish(0)
+                bend.pv.bdes._data['value'] = value
+                await bend.pv.bdes.publish(0)
+                bend.pv.bact._data['value'] = value
+                await bend.pv.bact.publish(0)
+                bend.pv.notify_state_change("bdes", value)
+                bend.pv.notify_state_change("bact", value)
     
-    def make_pvs(self, limit_vals):
+    def make_pvs(self, limit_vals, state_callback=None, ctrl_callback=None):
         for bend in self.bends:
             if bend != self.master_bend:
                 read_only = True
                 bend.make_pv(read_only, limit_vals[bend.device_name]['PREC'] if bend.device_name in limit_vals else None, 
                              limit_vals[bend.device_name]['HOPR'] if bend.device_name in limit_vals else None,
-                             limit_vals[bend.device_name]['LOPR'] if bend.device_name in limit_vals else None)
+                             limit_vals[bend.device_name]['LOPR'] if bend.device_name in limit_vals else None,
+                             state_callback=state_callback)
         # Now make the master bend PV        
-        async def change_callback(magnet_pv, value):
-            L.debug("Changing bend strength to %f", value)
-            self.send_field_strength_to_model(value)
-            for bend in self.bends:
-                if bend != self.master_bend:
-                    # Update all the non-master bend PVs, without triggering their callbacks.
-                    bend.pv.bctrl._data['value'] = value
-                    await bend.pv.bctrl.publish(0)
-                    bend.pv.bdes._data['value'] = value
-                    await bend.pv.bdes.publish(0)
-                    bend.pv.bact._data['value'] = value
-                    await bend.pv.bact.publish(0)
-                
         read_only = False 
         self.master_bend.make_pv(read_only, limit_vals[bend.device_name]['PREC'] if bend.device_name in limit_vals else None, 
                                            limit_vals[bend.device_name]['HOPR'] if bend.device_name in limit_vals else None,
                                            limit_vals[bend.device_name]['LOPR'] if bend.device_name in limit_vals else None,
-                                           change_callback)
+                                           state_callback=state_callback, ctrl_callback=ctrl_callback)
+        self.master_bend.pv.bend_string = self
                 
         return [bend.pv for bend in self.bends]
 
@@ -521,7 +929,7 @@ def main():
     _, run_options = ioc_arg_parser(
         default_prefix='',
         desc="Simulated Magnet Service")
-    run(service, **run_options)
+    run(service, **run_options, startup_hook=service.startup)
     
 if __name__ == '__main__':
     main()
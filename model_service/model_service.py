@@ -229,18 +229,29 @@ class ModelService:
         return np.stack((x_orb, y_orb, e))
 
     def get_screens(self):
-        screen_elements = self.tao_cmd('show ele monitor::YAG*,monitor::OTR*')[:-1]
-        zs = [float(row.split()[2]) for row in screen_elements]
-        names = [row.split()[1] for row in screen_elements]
-        return np.sort(np.array(
-            [(z, name) for z, name in zip(zs, names)],
-            dtype=[('z', 'float32'), ('ele', 'U60')]), order='z')
+        """
+        The screens' element indices, names and positions, in lattice order.  The indices
+        are resolved once here, so broadcasts can query just those elements (screen_lat_list).
+        """
+        elements = "1@0>>Monitor::YAG*,Monitor::OTR*|model"
+        ix_ele = [int(ix) for ix in self.tao_cmd(f"python lat_list -no_slaves -index_order {elements} ele.ix_ele")]
+        names = self.tao_cmd(f"python lat_list -no_slaves -index_order {elements} ele.name")
+        zs = self.tao.cmd_real(f"python lat_list -no_slaves -index_order {elements} real:ele.s") if ix_ele else []
+        screens = np.sort(np.array(list(zip(ix_ele, zs, names)),
+                                   dtype=[('ix_ele', 'int64'), ('z', 'float32'), ('ele', 'U60')]), order='ix_ele')
+        self.screen_list = "1@0>>{}|model".format(",".join(str(ix) for ix in screens['ix_ele']))
+        return screens
+
+    def screen_lat_list(self, who):
+        """ One real-valued attribute (like 'ele.a.beta') at every screen, as an array in self.screens order. """
+        if len(self.screens) == 0:
+            return np.zeros(0)
+        return self.tao.cmd_real(f"python lat_list -index_order {self.screen_list} real:{who}")
 
     def get_prof_orbit(self):
-        # get x,y positions at each screen
-        orbs = [self.tao_cmd(f'python ele:orbit {screen}|model') for _,screen in self.screens]
-        x_orb = np.array([float(orb[0].split(';')[3]) for orb in orbs])*1e3
-        y_orb = np.array([float(orb[2].split(';')[3]) for orb in orbs])*1e3
+        # get x,y positions at each screen, in mm
+        x_orb = self.screen_lat_list("orbit.vec.1")*1e3
+        y_orb = self.screen_lat_list("orbit.vec.3")*1e3
         return np.stack((x_orb, y_orb))
     
     def get_twiss(self):
@@ -275,23 +286,22 @@ class ModelService:
         self.model_broadcast_socket.send(orb)
 
     def send_profiles_data(self):
-        twiss_text = self.tao_cmd("show lat -no_label_lines -at beta_a -at beta_b -at e_tot Monitor::OTR*,Monitor::YAG*")
-        prof_beta_x = [float(l.split()[5]) for l in twiss_text]
-        prof_beta_y = [float(l.split()[6]) for l in twiss_text]
-        prof_e = [float(l.split()[7]) for l in twiss_text]
-        prof_names = [l.split()[1] for l in twiss_text]
-        prof_orbit = self.get_prof_orbit()
-        prof_data = np.concatenate((prof_orbit, np.array([prof_beta_x, prof_beta_y, prof_e,  prof_names])))
+        #one record per screen, so the numbers go out as numbers.  dtype.descr lets receivers rebuild the dtype.
+        prof_data = np.zeros(len(self.screens), dtype=[('name', 'U60'), ('x', 'float64'), ('y', 'float64'),
+                                                       ('beta_a', 'float64'), ('beta_b', 'float64'), ('e_tot', 'float64')])
+        prof_data['name'] = self.screens['ele']
+        prof_data['x'], prof_data['y'] = self.get_prof_orbit()
+        prof_data['beta_a'] = self.screen_lat_list("ele.a.beta")
+        prof_data['beta_b'] = self.screen_lat_list("ele.b.beta")
+        prof_data['e_tot'] = self.screen_lat_list("ele.e_tot")
 
-        metadata = {"tag" : "prof_data", "dtype": str(prof_data.dtype), "shape": prof_data.shape}
+        metadata = {"tag" : "prof_data", "dtype": prof_data.dtype.descr, "shape": prof_data.shape}
         self.model_broadcast_socket.send_pyobj(metadata, zmq.SNDMORE)
         self.model_broadcast_socket.send(prof_data);
 
     def send_particle_positions(self):
-        twiss_text = self.tao_cmd("show lat -no_label_lines -at beta_a -at beta_b -at e_tot Monitor::OTR*,Monitor::YAG*")
-        prof_names = [l.split()[1] for l in twiss_text]
         positions_all = {}
-        for screen in prof_names:
+        for screen in self.screens['ele'].tolist():
             positions = self.get_particle_positions(screen);
             if not positions:
                 continue
@@ -342,6 +352,13 @@ class ModelService:
                 except Exception as e:
                     L.error("Tao command failed: {}".format(e))
                     await s.send_pyobj({'status': 'fail', 'err': e})
+            elif p['cmd'] == 'tao_real':
+                try:
+                    retval = self.tao.cmd_real(p['val'])
+                    await s.send_pyobj({'status': 'ok', 'result': retval})
+                except Exception as e:
+                    L.error("Tao real command failed: {}".format(e))
+                    await s.send_pyobj({'status': 'fail', 'err': e})
             elif p['cmd'] == 'send_orbit':
                 self.model_changed() #Sets the flag that will cause an orbit broadcast
                 await s.send_pyobj({'status': 'ok'})
@@ -13,7 +13,7 @@ class RouteChannel:
     
     async def read(self, data_type):
         # First, call the getter to generate a new value.
-        value = await self.getter(self.pvname)
+        value = await self.getter(self.pvname) if self.getter else None
         if value is not None:
             # Update internal state to reflect new value.
             await self.write(value)
@@ -53,6 +53,10 @@ class Service(dict):
             pv_groups = {0: pv_groups}
         for prefix, group in pv_groups.items():
             self.update(**group.pvdb)
+
+    def add_alias(self, alias, pvname):
+        #An alias shares the original PV's channel, so one write updates both names and their monitors.
+        self[alias] = self[pvname]
     
     def __getitem__(self, pvname):
         chan = None
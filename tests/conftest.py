@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The services are scripts in their own directories rather than packages,
+# so put those directories on the path to import them by module name.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+for service in ('camera_service', 'klystron_service', 'magnet_service'):
+    sys.path.insert(0, os.path.join(ROOT, service))
@@ -0,0 +1,101 @@
+import asyncio
+
+import numpy as np
+import pytest
+from caproto import ChannelType
+
+import camera_service
+from camera_service import ProfMonService
+
+# No sensor size in screenProps.json, so it gets the default one.
+DEFAULTED_SCREEN = 'OTRS:LI25:920'
+
+
+@pytest.fixture(scope='module')
+def service():
+    return ProfMonService()
+
+
+def test_defaulted_screen_has_full_sensor_roi(service):
+    values = service.profiles[DEFAULTED_SCREEN]['props']['values']
+    dim = service.default_image_dim
+    assert list(values[[0, 1, 6, 7]]) == [dim]*4
+    assert list(values[[20, 21, 22, 23]]) == [0, 0, dim, dim]
+    assert service[DEFAULTED_SCREEN + ':ROI_XNP_SET'].value == dim
+
+
+def test_one_roi_axis_on_defaulted_screen(service):
+    dim = service.default_image_dim
+    asyncio.run(service.set_geometry(DEFAULTED_SCREEN, 20, 100))
+    values = service.profiles[DEFAULTED_SCREEN]['props']['values'].copy()
+    assert service.roi_shape(values) == (dim, dim - 100)
+    assert service[DEFAULTED_SCREEN + ':ROI_X'].value == 100
+    assert service[DEFAULTED_SCREEN + ':ROI_XNP'].value == dim - 100
+    assert service[DEFAULTED_SCREEN + ':ROI_YNP'].value == dim
+
+    # The rendered image, detector model included, matches the ROI readbacks.
+    camera_service.init_render_worker()
+    detector = camera_service.detector_layers(service.detector_maps(DEFAULTED_SCREEN), values)
+    assert detector is not None
+    beam = {'beta_a': 10.0, 'beta_b': 10.0, 'x': 0.0, 'y': 0.0, 'e': 1e9}
+    image = camera_service._renderer.gen_beam_image(beam, values, img_type="not_smooth", detector=detector)
+    assert image.size == dim*(dim - 100)
+
+
+def test_roi_size_is_clamped_to_sensor(service):
+    dim = service.default_image_dim
+    asyncio.run(service.set_geometry(DEFAULTED_SCREEN, 23, 0))
+    assert service[DEFAULTED_SCREEN + ':ROI_YNP'].value == 1
+    asyncio.run(service.set_geometry(DEFAULTED_SCREEN, 23, 10*dim))
+    assert service[DEFAULTED_SCREEN + ':ROI_YNP'].value == dim
+    assert np.prod(service.roi_shape(service.profiles[DEFAULTED_SCREEN]['props']['values'])) > 0
+
+
+def test_frame_cache_key(service):
+    values = service.profiles[DEFAULTED_SCREEN]['props']['values'].copy()
+    beam = {'beta_a': 10.0, 'beta_b': 10.0, 'x': 0.0, 'y': 0.0, 'e': 1e9}
+    key = service.frame_cache_key(DEFAULTED_SCREEN, beam, values, "not_smooth")
+    assert key is not None
+    # Beams that can't be quantized aren't cached.
+    for param, value in (('beta_a', 0.0), ('e', 0.0), ('beta_b', np.nan), ('x', np.inf)):
+        assert service.frame_cache_key(DEFAULTED_SCREEN, dict(beam, **{param: value}), values, "not_smooth") is None
+    # Neither bit depth nor the noise model can share a frame.
+    deeper = values.copy()
+    deeper[2] = 16 if values[2] != 16 else 12
+    assert service.frame_cache_key(DEFAULTED_SCREEN, beam, deeper, "not_smooth") != key
+    noisier = ProfMonService.__new__(ProfMonService)
+    noisier.readout_noise = 2*service.readout_noise
+    assert ProfMonService.frame_cache_key(noisier, DEFAULTED_SCREEN, beam, values, "not_smooth") != key
+
+
+def test_deep_images_are_short_waveforms(service):
+    devName, profile = next((devName, profile) for devName, profile in service.profiles.items()
+                            if profile['props']['values'][2] > 8)
+    image_pv = service[profile['props']['image_name']]
+    assert image_pv.data_type == ChannelType.INT
+    frame = np.array([0, 1, 2**15, 2**16 - 1], dtype=np.uint16)
+    value = service.image_pv_value(frame)
+    assert np.shares_memory(value, frame)
+    assert list(value.view(np.uint16)) == list(frame)
+
+
+def test_frame_ring_is_made_on_first_frame(service):
+    devName = next(devName for devName in service.profiles if devName not in service.frame_rings)
+    with pytest.raises(ValueError):
+        asyncio.run(service.select_buffered_frame(devName, 0))
+    assert devName not in service.frame_rings
+    frame = np.arange(10, dtype=service.image_dtype(service.profiles[devName]['props']['values'][2]))
+    image = service.buffer_frame(devName, frame)
+    assert devName in service.frame_rings
+    assert list(image) == list(frame)
+    assert service.frame_counts[devName] == 1
+
+
+def test_release_frame_buffers_twice():
+    service = ProfMonService()
+    service.detector_maps(DEFAULTED_SCREEN)
+    # A segment someone else already removed doesn't stop the rest being released.
+    next(iter(service.frame_buffers.values())).unlink()
+    service.release_frame_buffers()
+    assert not service.frame_buffers and not service.detector_buffers
+    service.release_frame_buffers()
@@ -0,0 +1,82 @@
+import asyncio
+
+import klystron_service
+
+
+class FakeModelSocket:
+    """ Stands in for the model's REQ socket, failing the first `failures` sends. """
+    def __init__(self, model):
+        self.model = model
+
+    async def send_pyobj(self, msg):
+        if self.model.failures:
+            self.model.failures -= 1
+            raise OSError("model unreachable")
+        self.model.batches.append(msg['val'])
+
+    async def recv_pyobj(self):
+        return {'status': 'ok', 'result': []}
+
+    def connect(self, addr):
+        pass
+
+    def close(self, linger=None):
+        pass
+
+
+class FakeModel:
+    def __init__(self, failures):
+        self.failures = failures
+        self.batches = []
+
+    def socket(self, socket_type):
+        return FakeModelSocket(self)
+
+
+class FakeKlystronPV:
+    element_name = 'O_K21_1'
+
+
+def make_service(model):
+    # Skip __init__, which asks the model for the klystron list.
+    service = klystron_service.KlystronService.__new__(klystron_service.KlystronService)
+    service.ctx = model
+    service.model_socket = model.socket(None)
+    service.pending_commands = {}
+    service.flush_task = None
+    service.retry_delay = service.flush_delay
+    return service
+
+
+def test_failed_batch_is_retried():
+    async def run():
+        model = FakeModel(failures=2)
+        service = make_service(model)
+        service.on_klystron_change(FakeKlystronPV(), 10.0, "ENLD")
+        for _ in range(100):
+            await asyncio.sleep(0.05)
+            if model.batches and service.flush_task is None:
+                break
+        return model, service
+
+    model, service = asyncio.run(run())
+    assert model.batches == [['set ele O_K21_1 ENLD_MeV = 10.0']]
+    assert model.failures == 0
+    assert service.pending_commands == {}
+    assert service.retry_delay == service.flush_delay
+
+
+def test_newer_change_replaces_requeued_one():
+    async def run():
+        model = FakeModel(failures=1)
+        service = make_service(model)
+        pv = FakeKlystronPV()
+        service.on_klystron_change(pv, 10.0, "ENLD")
+        await asyncio.sleep(service.flush_delay * 1.5)
+        service.on_klystron_change(pv, 20.0, "ENLD")
+        while service.flush_task is not None:
+            await asyncio.sleep(0.05)
+        return model
+
+    model = asyncio.run(run())
+    assert model.batches == [['set ele O_K21_1 ENLD_MeV = 20.0']]
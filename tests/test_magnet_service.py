@@ -0,0 +1,116 @@
+import asyncio
+import fnmatch
+import re
+
+import numpy as np
+import pytest
+
+import magnet_service
+import simulacrum
+
+
+def make_engine(send_to_model, failures):
+    async def publish(indices, values):
+        pass
+
+    async def on_failure(indices):
+        failures.append(list(indices))
+
+    engine = magnet_service.MagnetRampEngine([0.0, 0.0, 0.0], [-1.0] * 3, [1.0] * 3,
+                                             send_to_model, publish, on_failure)
+    engine.tick_period = 0.01
+    return engine
+
+
+def test_failed_step_stops_magnets_once():
+    sends = []
+    def send_to_model(indices, values):
+        sends.append(list(indices))
+        raise OSError("model unreachable")
+
+    async def run():
+        failures = []
+        engine = make_engine(send_to_model, failures)
+        runner = asyncio.get_running_loop().create_task(engine.run())
+        ramp = engine.ramp([0, 1], [[1.0], [1.0]])
+        with pytest.raises(OSError):
+            await asyncio.wait_for(ramp, 1.0)
+        # Let the engine tick a while longer: nothing is moving, so nothing is retried.
+        await asyncio.sleep(engine.tick_period * 10)
+        runner.cancel()
+        return engine, failures
+
+    engine, failures = asyncio.run(run())
+    assert not engine.moving.any()
+    assert failures == [[0, 1]]
+    assert len(sends) == 1
+    np.testing.assert_array_equal(engine.target, engine.current)
+
+
+class FakeTao:
+    """ A small lattice, with the element selections of the Tao commands the service uses.
+    Lords aren't tracking elements, and their slaves are. """
+    def __init__(self, elements):
+        self.elements = elements
+
+    def match(self, elements, kinds):
+        for ele in self.elements:
+            if ele['kind'] in kinds and any(ele['key'] == key.strip().lower() and fnmatch.fnmatchcase(ele['name'], pattern.strip())
+                                            for key, pattern in (item.split('::') for item in elements.split(','))):
+                yield ele
+
+    def show_ele_no_slaves(self, elements):
+        return [ele['name'] for ele in self.match(elements, ('plain', 'lord'))]
+
+    def show_lat(self, elements, tracking_elements=False):
+        return [ele['name'] for ele in self.match(elements, ('plain', 'slave') if tracking_elements else ('plain', 'lord', 'slave'))]
+
+    def lat_list(self, command):
+        flags, elements, who = re.match(r"python lat_list (.*) -index_order 1@0>>(.*)\|model (.*)", command).groups()
+        kinds = {'-no_slaves': ('plain', 'lord'), '-track_only': ('plain', 'slave')}[flags]
+        attr = who.split('.', 1)[1]
+        return [ele['name'] if attr == 'name' else ele.get(attr, 1.0) for ele in self.match(elements, kinds)]
+
+
+class FakeCmdSocket:
+    def __init__(self, tao):
+        self.tao = tao
+
+    def send_pyobj(self, msg):
+        result = self.tao.lat_list(msg['val'])
+        self.result = np.array(result, dtype=float) if msg['cmd'] == 'tao_real' else result
+
+    def recv_pyobj(self):
+        return {'result': self.result}
+
+
+def element(name, key, kind='plain', **attrs):
+    return dict(name=name, key=key, kind=kind, **attrs)
+
+
+LATTICE = [element('XC01B', 'hkicker'), element('YC01B', 'vkicker'), element('XCM01', 'hkicker'),
+           # A kicker that has a device, but isn't a corrector.
+           element('BKY170', 'hkicker'),
+           element('QCM01', 'quadrupole'),
+           # A split quad: only the lord has a device.
+           element('Q0H01', 'quadrupole', 'lord'), element('Q0H01#1', 'quadrupole', 'slave'), element('Q0H01#2', 'quadrupole', 'slave'),
+           element('Q0H02', 'multipole'),
+           element('BX01', 'sbend'), element('BXH2', 'sbend', 'lord'), element('BXH2#1', 'sbend', 'slave'), element('BXH2#2', 'sbend', 'slave')]
+
+
+def test_magnet_selection_matches_show_ele_and_show_lat():
+    tao = FakeTao(LATTICE)
+    # What the service selected with 'show ele -no_slaves' and 'show lat' queries.
+    listed = tao.show_ele_no_slaves("Hkicker::*,Vkicker::*") + tao.show_ele_no_slaves("Quadrupole::*,Multipole::*")
+    with_values = set(name for elements in ("Hkicker::X*", "Vkicker::Y*", "Quadrupole::* ", "Sbend::*", "Multipole::*")
+                      for name in tao.show_lat(elements) if name in simulacrum.util.element_names)
+    expected_devices = sorted(simulacrum.util.convert_element_to_device(name) for name in listed if name in with_values)
+    expected_bends = tao.show_lat("SBend::*", tracking_elements=True)
+
+    service = magnet_service.MagnetService.__new__(magnet_service.MagnetService)
+    service.cmd_socket = FakeCmdSocket(tao)
+    service.limits = {}
+    magnet_data = service.get_magnet_data_from_model()
+    assert sorted(service.get_initial_values(magnet_data)) == expected_devices
+    assert list(magnet_data['sbend']['name']) == expected_bends
+    assert len(expected_devices) == 6